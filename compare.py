@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+
+'''
+compare: measured scans against COMSOL and Biot-Savart on one grid.
+
+The measured scans, the COMSOL exports and the simulation outputs of a
+scan are each sampled at their own positions.  Each source here is an
+interpolator over its samples: the values can carry any trailing axes
+(field components, coils, ...), and are resampled linearly onto a
+common grid all at once.  The interpolation indices and weights are
+computed once per grid and kept, so resampling more values or calling
+again on the same grid costs only a gather.
+
+comparison holds the sources of a scan and computes the residual
+metrics (n, mean, rms and max of the difference over the grid points
+inside both sources' ranges) between every pair of sources and every
+trailing component in one broadcast.
+
+Usage:
+  comp=comparison()
+  comp.add('Measured',-positions,np.stack((z_data,-y_data,x_data),axis=-1))
+  comp.add('Free space',x_sim,np.stack((bx_sim,by_sim,bz_sim),axis=-1))
+  res=comp.residuals()
+  comp.print_report(components=['Bx','By','Bz'])
+'''
+
+import numpy as np
+
+# one record per (source,source,component...).  mean, rms and max are
+# of the first source minus the second over the n common grid points.
+residual_dtype=np.dtype([('n','i8'),
+                         ('mean','f8'),
+                         ('rms','f8'),
+                         ('max','f8')])
+
+class interpolator:
+    '''
+    piecewise linear interpolation of values (n,...) sampled at the
+    positions x (n,).  Outside the sampled range the result is nan.
+    '''
+    def __init__(self,x,values):
+        x=np.asarray(x,dtype=float)
+        self.order=np.argsort(x,kind='stable')
+        self.x=x[self.order]
+        self.values=np.asarray(values,dtype=float)[self.order]
+        if len(self.x)<2:
+            raise ValueError('need at least two samples to interpolate')
+        self.cache={} # grid bytes -> (index,weight,inside)
+
+    def weights(self,grid):
+        '''
+        for each grid point the sample index to its left, the weight of
+        the sample to its right, and whether it is inside the range
+        '''
+        grid=np.asarray(grid,dtype=float)
+        key=grid.tobytes()
+        if key not in self.cache:
+            i=np.clip(np.searchsorted(self.x,grid,side='right')-1,0,len(self.x)-2)
+            dx=self.x[i+1]-self.x[i]
+            t=(grid-self.x[i])/np.where(dx>0,dx,1)
+            inside=(grid>=self.x[0])&(grid<=self.x[-1])
+            self.cache[key]=(i,t,inside)
+        return self.cache[key]
+
+    def __call__(self,grid,values=None):
+        '''
+        the values (or other values sampled at the same positions, in
+        the original order) resampled on the grid, (ngrid,...)
+        '''
+        if values is None:
+            values=self.values
+        else:
+            values=np.asarray(values,dtype=float)[self.order]
+        i,t,inside=self.weights(grid)
+        t=t.reshape((-1,)+(1,)*(values.ndim-1))
+        res=values[i]*(1-t)+values[i+1]*t
+        res[~inside]=np.nan
+        return res
+
+class comparison:
+    '''
+    the sources of one scan, compared on a common grid.  The grid is
+    given, or else it is the positions of the first source inside the
+    range all sources cover, so that a measurement added first is
+    compared at its own points without being interpolated.
+    '''
+    def __init__(self,grid=None):
+        self.fixed_grid=None if grid is None else np.asarray(grid,dtype=float)
+        self.names=[]
+        self.sources=[]
+
+    def add(self,name,x,values=None):
+        '''
+        adds a source; values are (n,...) with the same trailing axes
+        for all the sources of the comparison.  x can also be an
+        interpolator shared with other comparisons, which then shares
+        its cached weights.
+        '''
+        self.names.append(name)
+        self.sources.append(x if isinstance(x,interpolator) else interpolator(x,values))
+
+    def grid(self):
+        if self.fixed_grid is not None:
+            return self.fixed_grid
+        lo=max(s.x[0] for s in self.sources)
+        hi=min(s.x[-1] for s in self.sources)
+        first=self.sources[0].x
+        return first[(first>=lo)&(first<=hi)]
+
+    def resample(self,grid=None):
+        '''
+        all sources on the grid, (nsources,ngrid,...)
+        '''
+        if grid is None:
+            grid=self.grid()
+        return np.stack([s(grid) for s in self.sources])
+
+    def residuals(self,grid=None):
+        '''
+        residual_dtype array (nsources,nsources,...) of every source
+        minus every other, over the grid points where both are defined
+        '''
+        r=self.resample(grid)
+        d=r[:,np.newaxis]-r[np.newaxis,:]
+        ok=~np.isnan(d)
+        d=np.where(ok,d,0.)
+        n=np.sum(ok,axis=2)
+        res=np.zeros(n.shape,dtype=residual_dtype)
+        res['n']=n
+        with np.errstate(invalid='ignore',divide='ignore'):
+            res['mean']=np.sum(d,axis=2)/n
+            res['rms']=np.sqrt(np.sum(d*d,axis=2)/n)
+        res['max']=np.where(n>0,np.max(np.abs(d),axis=2),np.nan)
+        return res
+
+    def print_report(self,res=None,components=None,reference=0):
+        '''
+        prints the residuals of every source against the reference
+        source (the first by default), one line per trailing component
+        '''
+        if res is None:
+            res=self.residuals()
+        for j,name in enumerate(self.names):
+            if j==reference:
+                continue
+            rows=res[reference,j].reshape(-1)
+            for k,row in enumerate(rows):
+                label=components[k] if components is not None else str(k)
+                print('%-14s - %-22s %-6s n=%4d  mean %10.4g  rms %10.4g  max %10.4g'
+                      %(self.names[reference],name,label,row['n'],row['mean'],row['rms'],row['max']))
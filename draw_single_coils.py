@@ -3,46 +3,96 @@
 # April 2025
 
 import pandas as pd
-import matplotlib.pyplot as plt
 import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from matplotlib.figure import Figure
 from tqdm import tqdm
+from report import write_index
+from fluxgate import load_scan
 
 filename = 'allcoils_Apr14.csv'
-os.makedirs('figures', exist_ok=True)
 
 # assumes gain 1000x and Mag13S-100 fluxgate
 
-# read file
-df = pd.read_csv(filename, comment='#')
+def coil_table(filename):
+    '''
+    Field of every coil at every position, in one groupby over (coil, position).
 
-coils = df.coil.unique()
-df.set_index('coil', inplace=True)
-plt.figure()
+    The session is read with fluxgate.load_scan, through its cache, and each
+    pair is signed by its state column, (B(+1) - B(-1))/2: the coil field for
+    the +1 state with the background removed, in nT, at positions in m. The mean over
+    the n pairs at a position has the uncertainty sqrt(sum dB**2)/n, as in
+    fluxgate.sessionfollower.
 
-for coil in tqdm(coils):
-    df_coil = df.loc[coil, :]
+    Returns a tidy table with columns coil, position, Bx, By, Bz, dBx, dBy, dBz.
+    '''
+    scan = pd.DataFrame(load_scan(filename))
 
-    # to nT
+    # fields and squared errors of all pairs at once
+    columns = {'coil': scan.coil, 'position': scan.position}
     for i in 'xyz':
-        df_coil[f'B{i} (V)'] *= 10
-        df_coil[f'dB{i} (V)'] *= 10
-        df_coil[f'dB{i} (V)'] = df_coil[f'dB{i} (V)']**2
-        df_coil[f'B{i} (V)'] *= df_coil.state
+        columns[f'B{i}'] = scan[f'b{i}']
+        columns[f'dB{i}'] = scan[f'db{i}']**2
 
     # average positions
-    df_coil = df_coil.groupby('position').mean()
+    groups = pd.DataFrame(columns).groupby(['coil', 'position'])
+    table = groups[['Bx', 'By', 'Bz']].mean()
+    n = groups.size()
+    for i in 'xyz':
+        table[f'dB{i}'] = groups[f'dB{i}'].sum()**0.5 / n
+    return table.reset_index()
+
+def coil_matrix(table):
+    '''
+    Measured response matrix from coil_table: one row per (axis, position),
+    one column per coil, in nT for the current of the +1 state.
+    '''
+    long = table.melt(id_vars=['coil', 'position'], value_vars=['Bx', 'By', 'Bz'], var_name='axis')
+    return long.pivot(index=['axis', 'position'], columns='coil', values='value')
+
+def draw_coil(coil, data, outdir):
+    '''
+    Draws the map of one coil into outdir/coil{coil}.png. data holds the
+    position, B and dB arrays of the coil from coil_table. The figure is
+    made without pyplot so that it renders on the Agg canvas in any
+    process, with no display.
+    '''
+    fig = Figure()
+    ax = fig.add_subplot()
 
     # draw
     for i in 'xyz':
-        df_coil[f'dB{i} (V)'] = df_coil[f'dB{i} (V)']**0.5
-        plt.errorbar(df_coil.index, df_coil[f'B{i} (V)'], df_coil[f'dB{i} (V)'], fmt='.', label=f'$B_{i}$')
+        ax.errorbar(data['position'], data[f'B{i}'], data[f'dB{i}'], fmt='.', label=f'$B_{i}$')
 
     # plot elements
-    plt.title(f'Coil {coil}')
-    plt.xlabel('Position (cm)')
-    plt.ylabel('Field (nT)')
-    plt.grid(which='both', visible=True)
-    plt.legend()
-    plt.savefig(f'figures/coil{coil}.png')
-    plt.gca().clear()
-plt.close('all')
+    ax.set_title(f'Coil {coil}')
+    ax.set_xlabel('Position (m)')
+    ax.set_ylabel('Field (nT)')
+    ax.grid(which='both', visible=True)
+    ax.legend()
+    name = f'coil{coil}.png'
+    fig.savefig(os.path.join(outdir, name))
+    return name
+
+def draw_gallery(table, outdir='figures', workers=None):
+    '''
+    Draws every coil of coil_table in a pool of workers processes (one per
+    cpu by default), then writes outdir/index.html with all of them.
+    Only the arrays of each coil are sent to the workers.
+    '''
+    os.makedirs(outdir, exist_ok=True)
+    coils = []
+    arrays = []
+    for coil, df_coil in table.groupby('coil'):
+        coils.append(coil)
+        arrays.append({col: df_coil[col].to_numpy() for col in df_coil.columns if col != 'coil'})
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        names = list(tqdm(pool.map(draw_coil, coils, arrays, [outdir]*len(coils)), total=len(coils)))
+    write_index(outdir, [(name, f'Coil {coil}') for coil, name in zip(coils, names)], title=filename)
+    return names
+
+if __name__ == '__main__':
+    # optional argument: number of worker processes
+    workers = int(sys.argv[1]) if len(sys.argv) > 1 else None
+    draw_gallery(coil_table(filename), 'figures', workers)
@@ -0,0 +1,400 @@
+#!/usr/bin/env python3
+
+'''
+fluxgate: reading the fluxgate mapping sessions.
+
+A session is a csv file written by the mapping acquisition: a block of
+'#' lines with the session name and its settings (naxes, device,
+pos_unit, ...), a line of column names, and then one row per reading.
+Each position is read twice, with the coil current in the +1 and -1
+state, on consecutive rows.  The coil field is half the difference of
+the two readings, which removes the background field.
+
+Here the pairing, the V->nT conversion (100 nT/10 V) and the position
+unit conversion are done as strided array operations on whole columns,
+for any number of files, and each scan comes back as one record per
+position.
+
+Parsing a csv is done once per session: open_session() stores every
+column as a .npy file next to a JSON sidecar holding the header, and
+later loads memory-map the columns instead of parsing the text again.
+The sidecar records the size and modification time of the csv, so a
+session that is still being written is parsed again when it changes.
+
+sessionfollower reads a session while the acquisition is still writing
+it: each poll() parses only the rows appended since the last one, pairs
+them, and merges them into running per (coil,position) moments, so the
+averages and their uncertainties are there during the run.  follow()
+polls in a loop and hands every update to a callback, e.g. liveplot.
+
+Usage:
+  g10,coil4=load_scans(['G10_Apr3.csv','coil4_Apr3.csv'])
+  plt.scatter(g10['position'],g10['bz'])
+
+  python3 fluxgate.py allcoils_Apr14.csv    # live plot while mapping
+'''
+
+import json
+import os
+import time
+import numpy as np
+from roistats import label_moments, merge_label_moments
+
+nT_per_volt=100/10 # Mag13 with 1000x gain: field(nT)=field(V)*(100 nT/10 V)
+
+# metres per unit of the pos_unit setting in the header
+pos_units={'m':1.0,'cm':0.01,'mm':0.001}
+
+# one record per position of a scan.  Fields in nT, position in m, coil
+# is -1 for sessions without a coil column.
+scan_dtype=np.dtype([('position','f8'),
+                     ('bx','f8'),
+                     ('by','f8'),
+                     ('bz','f8'),
+                     ('dbx','f8'),
+                     ('dby','f8'),
+                     ('dbz','f8'),
+                     ('coil','i8')])
+
+def parse_header(lines):
+    '''
+    parses the '#' block of a session from its lines.  Returns
+    (meta,names,nskip): the settings as a dict of strings (the first
+    line gives meta['name']), the column names, and the number of lines
+    before the first row.  Returns None if the lines end before the
+    column names.
+    '''
+    meta={}
+    nskip=0
+    for line in lines:
+        nskip+=1
+        if not line.startswith('#'):
+            names=[name.strip() for name in line.split(',')]
+            return meta,names,nskip
+        text=line[1:].strip()
+        if nskip==1:
+            meta['name']=text
+        elif ':' in text:
+            key,value=text.split(':',1)
+            meta[key.strip()]=value.strip()
+    return None
+
+# one record per (coil,position) of a followed session.  b* are the
+# means of the pairs, db* their uncertainty propagated from the
+# readings, and sb* the standard error from the scatter of repeated
+# pairs (nan with a single pair).
+average_dtype=np.dtype([('coil','i8'),
+                        ('position','f8'),
+                        ('n','i8'),
+                        ('bx','f8'),
+                        ('by','f8'),
+                        ('bz','f8'),
+                        ('dbx','f8'),
+                        ('dby','f8'),
+                        ('dbz','f8'),
+                        ('sbx','f8'),
+                        ('sby','f8'),
+                        ('sbz','f8')])
+
+def read_header(filename):
+    '''
+    reads the '#' block of a session, see parse_header()
+    '''
+    with open(filename) as f:
+        header=parse_header(f)
+    if header is None:
+        raise ValueError('%s: no column names after the header'%filename)
+    return header
+
+def read_session(filename):
+    '''
+    reads a whole session.  Returns (meta,columns), where columns maps
+    each column name to its array.
+    '''
+    meta,names,nskip=read_header(filename)
+    data=np.loadtxt(filename,delimiter=',',skiprows=nskip,ndmin=2)
+    return meta,{name:data[:,i] for i,name in enumerate(names)}
+
+def cache_path(filename,cache_dir=None):
+    '''
+    directory holding the cached columns of a session, next to the csv
+    unless cache_dir is given
+    '''
+    if cache_dir is None:
+        return filename+'.cache'
+    return os.path.join(cache_dir,os.path.basename(filename)+'.cache')
+
+def source_stamp(filename):
+    st=os.stat(filename)
+    return {'size':st.st_size,'mtime_ns':st.st_mtime_ns}
+
+def write_session_cache(filename,cache_dir=None):
+    '''
+    parses a session and stores it: one .npy file per column, and
+    session.json with the header, the column names and the stamp of
+    the csv.  The sidecar is written last, through a temporary name,
+    so an interrupted write leaves no valid cache behind.
+    Returns (meta,columns) as read_session().
+    '''
+    stamp=source_stamp(filename)
+    meta,columns=read_session(filename)
+    path=cache_path(filename,cache_dir)
+    os.makedirs(path,exist_ok=True)
+    names=list(columns)
+    for i,name in enumerate(names):
+        np.save(os.path.join(path,'col%i.npy'%i),columns[name])
+    sidecar=os.path.join(path,'session.json')
+    with open(sidecar+'.tmp','w') as f:
+        json.dump({'meta':meta,'columns':names,'source':stamp},f,indent=1)
+    os.replace(sidecar+'.tmp',sidecar)
+    return meta,columns
+
+def open_session(filename,cache_dir=None):
+    '''
+    same as read_session(), but through the column cache: the columns
+    are memory-mapped read-only from the cache if it matches the csv,
+    otherwise the csv is parsed and the cache (re)written.
+    '''
+    path=cache_path(filename,cache_dir)
+    try:
+        with open(os.path.join(path,'session.json')) as f:
+            sidecar=json.load(f)
+    except (OSError,ValueError):
+        sidecar=None
+    if sidecar is None or sidecar['source']!=source_stamp(filename):
+        return write_session_cache(filename,cache_dir)
+    columns={name:np.load(os.path.join(path,'col%i.npy'%i),mmap_mode='r')
+             for i,name in enumerate(sidecar['columns'])}
+    return sidecar['meta'],columns
+
+def pair_states(values,sign=1):
+    '''
+    sign*(second-first)/2 of each pair of consecutive rows; a last
+    unpaired row is dropped.  sign may also be an array, one per pair.
+    '''
+    n=len(values)//2*2
+    return sign*(values[1:n:2]-values[0:n:2])/2
+
+def pair_uncertainty(errors):
+    '''
+    uncertainty of pair_states() from the uncertainties of the rows
+    '''
+    n=len(errors)//2*2
+    return np.sqrt(errors[0:n:2]**2+errors[1:n:2]**2)/2
+
+def scan_from_columns(meta,columns,sign=1):
+    '''
+    pairs the rows of a session read by read_session() into a scan
+    array of scan_dtype.  With a state column each pair is signed by
+    its states, as draw_single_coils.py did with state*B: the field is
+    (B(+1)-B(-1))/2 whichever state was read first, and sign is not
+    used.  Without one, sign=1 takes second-first and sign=-1
+    first-second.
+    '''
+    if 'state' in columns:
+        state=np.asarray(columns['state'])
+        n=len(state)//2*2
+        if np.any(state[0:n:2]!=-state[1:n:2]):
+            raise ValueError('%s: consecutive rows are not a +/- state pair'%meta.get('name'))
+        sign=-state[0:n:2]
+    scale=pos_units[meta.get('pos_unit','cm')]
+    position=columns['position']
+    scan=np.zeros(len(position)//2,dtype=scan_dtype)
+    scan['position']=position[0:2*len(scan):2]*scale
+    for axis in 'xyz':
+        scan['b'+axis]=pair_states(columns['B%s (V)'%axis],sign)*nT_per_volt
+        scan['db'+axis]=pair_uncertainty(columns['dB%s (V)'%axis])*nT_per_volt
+    scan['coil']=columns['coil'][0:2*len(scan):2] if 'coil' in columns else -1
+    return scan
+
+def load_scan(filename,sign=1,cache=True,cache_dir=None):
+    '''
+    the scan of one session file, see scan_from_columns().  The file
+    is read through open_session() unless cache=False.
+    '''
+    if cache:
+        return scan_from_columns(*open_session(filename,cache_dir),sign=sign)
+    return scan_from_columns(*read_session(filename),sign=sign)
+
+def load_scans(filenames,signs=None,cache=True,cache_dir=None):
+    '''
+    the scans of several session files, as a list in the same order.
+    signs gives the sign for each file (all +1 by default), used for
+    the files without a state column.
+    '''
+    if signs is None:
+        signs=[1]*len(filenames)
+    return [load_scan(filename,sign,cache,cache_dir) for filename,sign in zip(filenames,signs)]
+
+class sessionfollower:
+    '''
+    follows a session csv as it grows.  Only complete lines are parsed,
+    a row waiting for its partner state is kept for the next poll, and
+    a file that shrinks (a new session under the same name) is read
+    again from the start.
+    '''
+    def __init__(self,filename,sign=1):
+        self.filename=filename
+        self.sign=sign
+        self.reset()
+
+    def reset(self):
+        self.offset=0 # bytes of the file read so far
+        self.partial=b'' # an incomplete last line
+        self.header_lines=[]
+        self.meta=None
+        self.names=None
+        self.unpaired=np.zeros((0,0))
+        self.labels={} # (coil,position) -> label
+        self.moments={} # axis -> (n,mean,m2,min,max) arrays per label
+        self.errsq={} # axis -> sum of squared reading uncertainties per label
+        self.npairs=0
+
+    def read_lines(self):
+        if os.path.getsize(self.filename)<self.offset:
+            self.reset()
+        with open(self.filename,'rb') as f:
+            f.seek(self.offset)
+            data=f.read()
+        self.offset+=len(data)
+        data=self.partial+data
+        end=data.rfind(b'\n')+1
+        self.partial=data[end:]
+        return data[:end].decode().splitlines()
+
+    def poll(self):
+        '''
+        parses the rows appended since the last poll and merges their
+        pairs into the averages.  Returns the labels that changed.
+        '''
+        lines=self.read_lines()
+        if self.names is None:
+            self.header_lines+=lines
+            header=parse_header(self.header_lines)
+            if header is None:
+                return np.zeros(0,dtype=int)
+            self.meta,self.names,nskip=header
+            lines=self.header_lines[nskip:]
+            self.header_lines=[]
+            self.unpaired=np.zeros((0,len(self.names)))
+        rows=[line for line in lines if line.strip()]
+        if not rows:
+            return np.zeros(0,dtype=int)
+        data=np.concatenate((self.unpaired,np.loadtxt(rows,delimiter=',',ndmin=2)))
+        n=len(data)//2*2
+        self.unpaired=data[n:]
+        if n==0:
+            return np.zeros(0,dtype=int)
+        scan=scan_from_columns(self.meta,{name:data[:n,i] for i,name in enumerate(self.names)},self.sign)
+        return self.add(scan)
+
+    def add(self,scan):
+        '''
+        merges a scan array into the running averages.  Returns the
+        labels that changed.
+        '''
+        labels=np.array([self.labels.setdefault(key,len(self.labels))
+                         for key in zip(scan['coil'].tolist(),scan['position'].tolist())],dtype=np.intp)
+        nlabels=len(self.labels)
+        for axis in 'xyz':
+            new=label_moments(labels,scan['b'+axis],nlabels)
+            old=self.moments.get(axis)
+            if old is not None:
+                # labels first seen in this scan start out empty
+                pad=nlabels-len(old[0])
+                old=tuple(np.append(m,np.full(pad,fill)) for m,fill in zip(old,(0,np.nan,0.,np.inf,-np.inf)))
+                new=merge_label_moments(old,new)
+            self.moments[axis]=new
+            errsq=np.bincount(labels,weights=scan['db'+axis]**2,minlength=nlabels)
+            old=self.errsq.get(axis,np.zeros(0))
+            errsq[:len(old)]+=old
+            self.errsq[axis]=errsq
+        self.npairs+=len(scan)
+        return np.unique(labels)
+
+    def table(self,labels=None):
+        '''
+        the averages as an array of average_dtype, for the given labels
+        or for all of them sorted by coil and position
+        '''
+        keys=list(self.labels)
+        if labels is None:
+            labels=np.array(sorted(range(len(keys)),key=lambda i:keys[i]),dtype=np.intp)
+        res=np.zeros(len(labels),dtype=average_dtype)
+        if len(labels)==0:
+            return res
+        res['coil']=[keys[i][0] for i in labels]
+        res['position']=[keys[i][1] for i in labels]
+        for axis in 'xyz':
+            n,mean,m2,vmin,vmax=self.moments[axis]
+            res['n']=n[labels]
+            res['b'+axis]=mean[labels]
+            res['db'+axis]=np.sqrt(self.errsq[axis][labels])/n[labels]
+            with np.errstate(invalid='ignore',divide='ignore'):
+                res['sb'+axis]=np.where(n[labels]>1,np.sqrt(m2[labels]/(n[labels]-1)/n[labels]),np.nan)
+        return res
+
+    def follow(self,callback=None,interval=1.0,idle=None):
+        '''
+        polls every interval seconds and calls callback(self,labels)
+        whenever pairs were added, until no rows came for idle seconds
+        (never if idle is None) or the loop is interrupted with ctrl-c.
+        Returns the final table().
+        '''
+        last=time.time()
+        try:
+            while True:
+                labels=self.poll()
+                if len(labels):
+                    last=time.time()
+                    if callback is not None:
+                        callback(self,labels)
+                elif idle is not None and time.time()-last>idle:
+                    break
+                time.sleep(interval)
+        except KeyboardInterrupt:
+            pass
+        return self.table()
+
+class liveplot:
+    '''
+    callback for sessionfollower.follow(): redraws the map of the coil
+    that was last measured.  For a session with a state column, or one
+    without it followed with sign=-1 as from the command line, this is
+    the map of draw_single_coils.py: the +1 state field in nT against
+    position in m, with the same errors.
+    '''
+    def __init__(self):
+        import matplotlib.pyplot as plt
+        self.plt=plt
+        plt.ion()
+        self.fig,self.ax=plt.subplots()
+
+    def __call__(self,follower,labels):
+        res=follower.table()
+        coil=follower.table(labels[-1:])['coil'][0]
+        res=res[res['coil']==coil]
+        self.ax.clear()
+        for axis in 'xyz':
+            self.ax.errorbar(res['position'],res['b'+axis],res['db'+axis],fmt='.',label=f'$B_{axis}$')
+        self.ax.set_title(f'{follower.meta.get("name")}: coil {coil}, {follower.npairs} pairs')
+        self.ax.set_xlabel('Position (m)')
+        self.ax.set_ylabel('Field (nT)')
+        self.ax.grid(which='both',visible=True)
+        self.ax.legend()
+        self.plt.pause(0.001)
+
+if __name__=='__main__':
+    from optparse import OptionParser
+    parser=OptionParser(usage='%prog [options] session.csv')
+    parser.add_option('-i','--interval',dest='interval',default=1.0,type='float',
+                      help='seconds between polls of the file')
+    parser.add_option('--idle',dest='idle',default=None,type='float',
+                      help='stop after this many seconds without new rows')
+    parser.add_option('--sign',dest='sign',default=-1,type='int',
+                      help='sign of the pairs in a session without a state column; the default -1 gives (B(+1)-B(-1))/2 as in draw_single_coils.py when the +1 state is read first')
+    (options,args)=parser.parse_args()
+    if len(args)!=1:
+        parser.error('give one session file')
+    follower=sessionfollower(args[0],sign=options.sign)
+    follower.follow(liveplot(),options.interval,options.idle)
@@ -10,6 +10,10 @@ import math
 import csv
 import numpy as np
 from math import sqrt
+# optional argument: a directory to save the figures into, with an index page, instead of showing them
+if len(sys.argv)>1:
+    from report import headless
+    headless(sys.argv[1])
 import matplotlib.pyplot as plt
 
 #load COMSOL xscan_comsol.txt data
@@ -33,42 +37,13 @@ import json
 with open('data.json') as json_file:
     graphdata=json.load(json_file)
 
-#reading in gradient data:
-data= np.loadtxt('May28_2.0.csv', delimiter=',', skiprows=19, usecols=(1,2,3,7))
-print(data)
-bx=data[:,0]
-by=data[:,1]
-bz=data[:,2]
-
-
-positions=data[:,3]
-
-pos=[]
-bx_ave=[]
-by_ave=[]
-bz_ave=[]
-
-for i in range(0, len(bx)-1, 2):  # Start at 0, stop at len(bx)-1, step by 2
-    try:
-        is_length_same=len(bx)==len(by)==len(bz)
-        print('prepare for averaging...',)
-    except: ValueError
-    
-    x_ave=(bx[i+1] - bx[i]) / 2
-    y_ave=(by[i+1] - by[i]) / 2
-    z_ave=(bz[i+1] - bz[i]) / 2
-    
-    bx_ave=np.append(bx_ave,x_ave)
-    by_ave=np.append(by_ave,y_ave)
-    bz_ave=np.append(bz_ave,z_ave)
-    
-for i in range(0, len(positions), 2): 
-    pos_metres=positions[i]*(0.01) #in metres
-    pos=np.append(pos,pos_metres)
-    
-bx_meas=bx_ave*(100/10) #field(nT)=field(V)*(100 nT/10 V)
-by_meas=by_ave*(100/10)
-bz_meas=bz_ave*(100/10)
+#reading in gradient data: half difference of the +/- current states, in nT and m
+#the pairs come signed by their state column as (B(+1)-B(-1))/2, compared here as (B(-1)-B(+1))/2
+from fluxgate import load_scan
+
+scan=load_scan('May28_2.0.csv')
+pos=scan['position']
+bx_meas,by_meas,bz_meas=-scan['bx'],-scan['by'],-scan['bz']
 
 
 # Load COMSOL G10 xscan
@@ -8,6 +8,10 @@ import time
 import sys
 import math
 from math import sqrt
+# optional argument: a directory to save the figures into, with an index page, instead of showing them
+if len(sys.argv)>1:
+    from report import headless
+    headless(sys.argv[1])
 import matplotlib.pyplot as plt
 
 # load theoretical fields
@@ -57,61 +61,15 @@ import json
 with open('data.json') as json_file:
     graphdata=json.load(json_file)
 
-#fluxgate measurement data from TRIUMF  April 3, 2025
+#fluxgate measurement data from TRIUMF  April 3, 2025: all coils, coil 4 and coil 22
+#each position is the half difference of the +/- current states, in nT and m
+#the pairs come signed by their state column as (B(+1)-B(-1))/2; all coils and coil 22 are compared as (B(-1)-B(+1))/2
 
-import csv
-import numpy as np
-
-data= np.loadtxt('G10_Apr3.csv', delimiter=',', skiprows=19, usecols=(1,2,3,7))
-print(data)
-bx=data[:,0]
-by=data[:,1]
-bz=data[:,2]
-pos=data[:,3]
-#print('pos is:',pos)
-
-'''
-print((bx[1]-bx[0])/2)
-print((bx[3]-bx[2])/2)
-print((bx[5]-bx[4])/2)
-print((bx[7]-bx[6])/2)
-
-'''
-
-#bx_ave=[]
-bx_ave=np.empty(0, dtype='float64')
-for i in range(0, len(bx)-1, 2):  # Start at 0, stop at len(bx)-1, step by 2
-    x_ave=(bx[i+1] - bx[i]) / 2
-    #print(x_ave)
-    bx_ave=np.append(bx_ave,x_ave)
-print('bx_ave is:',bx_ave)
-print()
-by_ave=np.empty(0, dtype='float64')
-for i in range(0, len(by)-1, 2):  # Start at 0, stop at len(bx)-1, step by 2
-    y_ave=(by[i+1] - by[i]) / 2
-    #print(y_ave)
-    by_ave=np.append(by_ave,y_ave)
-print('by_ave is:',by_ave)
-print()
-bz_ave=np.empty(0, dtype=np.float64)
-for i in range(0, len(bz)-1, 2):  # Start at 0, stop at len(bx)-1, step by 2
-    z_ave=(bz[i+1] - bz[i]) / 2
-    #print(z_ave)
-    bz_ave=np.append(bz_ave,z_ave)
-print('bz_ave is:',bz_ave)
-print()
-positions=np.empty(0, dtype='float64')
-for i in range(0, len(pos), 2): 
-    position=pos[i]*(0.01) #in m
-    #print(position)
-    positions=np.append(positions,position)
-
-print(len(positions),'positions is:',positions)
-
-x_data=bx_ave*(100/10) # field(nT)=field(V)*(100 nT/10 V)
-y_data=by_ave*(100/10)
-z_data=bz_ave*(100/10)
+from fluxgate import load_scans
 
+scan,scan4,scan22=load_scans(['G10_Apr3.csv','coil4_Apr3.csv','coil22_Apr3.csv'])
+positions=scan['position']
+x_data,y_data,z_data=-scan['bx'],-scan['by'],-scan['bz']
 print(len(x_data),'x_data is:',x_data)
 
 # COMSOL all coils
@@ -125,41 +83,8 @@ by_com_all=data_com[:,4]*3*(10**9)
 bz_com_all=data_com[:,5]*3*(10**9)#nT
 print(by_com_all)
 
-# coil 4 fluxgate meausurement April 3, 2025
-print('Coil 4 data')
-data4= np.loadtxt('coil4_Apr3.csv', delimiter=',', skiprows=19, usecols=(1,2,3,7))
-print(data)
-bx=data4[:,0]
-by=data4[:,1]
-bz=data4[:,2]
-pos=data4[:,3]
-#print('pos is:',pos)
-
-bx_ave4=np.empty(0, dtype='float64')
-for i in range(0, len(bx)-1, 2):  # Start at 0, stop at len(bx)-1, step by 2
-    x_ave4=(bx[i] - bx[i+1]) / 2
-    #print(x_ave4)
-    bx_ave4=np.append(bx_ave4,x_ave4)
-print('bx_ave for coil 4 is:',bx_ave4)
-print()
-by_ave4=np.empty(0, dtype='float64')
-for i in range(0, len(by)-1, 2):  # Start at 0, stop at len(bx)-1, step by 2
-    y_ave4=(by[i] - by[i+1]) / 2
-    #print(y_ave4)
-    by_ave4=np.append(by_ave4,y_ave4)
-print('by_ave for coil 4 is:',by_ave4)
-print()
-bz_ave4=np.empty(0, dtype='float64')
-for i in range(0, len(bz)-1, 2):  # Start at 0, stop at len(bx)-1, step by 2
-    z_ave4=(bz[i] - bz[i+1]) / 2
-    #print(z_ave4)
-    bz_ave4=np.append(bz_ave4,z_ave4)
-print('bz_ave for coil 4 is:',bz_ave4)
-print()
-
-x_data4=bx_ave4*(100/10) # field(nT)=field(V)*(100 nT/10 V)
-y_data4=by_ave4*(100/10)
-z_data4=bz_ave4*(100/10)
+# coil 4 fluxgate meausurement April 3, 2025, read above
+x_data4,y_data4,z_data4=scan4['bx'],scan4['by'],scan4['bz']
 
 #load coil 4 COMSOL  data G10
 
@@ -173,42 +98,8 @@ bx_com_4=data_com[:,1]*3
 print(bx_com_4)
 
 
-# coil 22 fluxgate meausurement April 3, 2025
-
-print('Coil 22 data')
-data22= np.loadtxt('coil22_Apr3.csv', delimiter=',', skiprows=19, usecols=(1,2,3,7))
-print(data)
-bx=data22[:,0]
-by=data22[:,1]
-bz=data22[:,2]
-pos=data22[:,3]
-#print('pos is:',pos)
-
-bx_ave22=np.empty(0, dtype='float64')
-for i in range(0, len(bx)-1, 2):  # Start at 0, stop at len(bx)-1, step by 2
-    x_ave22=(bx[i+1] - bx[i]) / 2
-    #print(x_ave22)
-    bx_ave22=np.append(bx_ave22,x_ave22)
-print('bx_ave for coil 22 is:',bx_ave22)
-print()
-by_ave22=np.empty(0, dtype='float64')
-for i in range(0, len(by)-1, 2):  # Start at 0, stop at len(bx)-1, step by 2
-    y_ave22=(by[i+1] - by[i]) / 2
-    #print(y_ave22)
-    by_ave22=np.append(by_ave22,y_ave22)
-print('by_ave for coil 22 is:',by_ave22)
-print()
-bz_ave22=np.empty(0, dtype='float64')
-for i in range(0, len(bz)-1, 2):  # Start at 0, stop at len(bx)-1, step by 2
-    z_ave22=(bz[i+1] - bz[i]) / 2
-    #print(z_ave22)
-    bz_ave22=np.append(bz_ave22,z_ave22)
-print('bz_ave for coil 22 is:',bz_ave22)
-print()
-
-x_data22=bx_ave22*(100/10) # field(nT)=field(V)*(100 nT/10 V)
-y_data22=by_ave22*(100/10)
-z_data22=bz_ave22*(100/10)
+# coil 22 fluxgate meausurement April 3, 2025, read above
+x_data22,y_data22,z_data22=-scan22['bx'],-scan22['by'],-scan22['bz']
 
 '''
 scanning direction along x-axis
@@ -218,6 +109,38 @@ fluxgate minus y-axis direction =  y-axis direction in simulation
 fluxgate x-axis direction =  posi z-axis direction in simulation
 '''
 
+#residuals of the measurements against the models, on the measured positions
+#the fluxgate axes are mapped onto the simulation axes as above, and plotted against -positions
+
+from compare import comparison, interpolator
+
+components=['Bx','By','Bz']
+free_space=interpolator(x_sim,np.stack((bx_sim,by_sim,bz_sim),axis=-1))
+image_current=interpolator(x_sim,np.stack((bx_sim_app,by_sim_app,bz_sim_app),axis=-1))
+
+print('All coils:')
+comp=comparison()
+comp.add('Measured',-positions,np.stack((z_data,-y_data,x_data),axis=-1))
+comp.add('Free space',free_space)
+comp.add('Image currents',image_current)
+comp.add('COMSOL',pos_com_all,np.stack((bx_com_all,by_com_all,bz_com_all),axis=-1))
+comp.print_report(components=components)
+
+print('Coil 4:')
+comp4=comparison()
+comp4.add('Measured',positions,z_data4)
+comp4.add('Free space',x_sim,bx_sim)
+comp4.add('Image currents',x_sim,bx_sim_app)
+comp4.add('COMSOL',pos_com_4,bx_com_4)
+comp4.print_report(components=['Bx'])
+
+print('Coil 22:')
+comp22=comparison()
+comp22.add('Measured',-positions,np.stack((z_data22,-y_data22,x_data22),axis=-1))
+comp22.add('Free space',free_space)
+comp22.add('Image currents',image_current)
+comp22.print_report(components=components)
+
 
 #Now plots
 
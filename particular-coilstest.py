@@ -76,6 +76,8 @@ parser.add_option("-w", "--wiggle", dest="wiggle",
 d=dipole(0,0,1.2,0,0,1)  # dipole2
 #d=dipole(0,0,1.2,1,0,0)  # dipole3
 
+parser.add_option("--report", dest="report", default=None,
+                  help="save the figures into this directory with an index page instead of showing them")
 (options,args)=parser.parse_args()
 
 l=int(options.l)
@@ -264,6 +266,9 @@ print('the vector test')
 print(len(myarray.vec_b()),myarray.vec_b())
 
 import matplotlib as mpl
+if(options.report):
+    from report import headless
+    headless(options.report) # Agg backend, plt.show() saves the figures
 from mpl_toolkits.mplot3d import Axes3D
 import numpy as np
 import matplotlib.pyplot as plt
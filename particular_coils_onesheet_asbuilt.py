@@ -24,6 +24,8 @@ import numpy as np
 from patchlib.patch import *
 from Pis.Pislib import *
 from dipole import *
+from tolerance import *
+from roistats import edmcells
 
 from pipesfitting import *
 
@@ -76,11 +78,21 @@ parser.add_option("-p", "--makeplots", dest="makeplots", default=False,
 parser.add_option("-w", "--wiggle", dest="wiggle",
                   action="store_true",
                   default=False, help="wiggle each point")
+parser.add_option("-N", "--trials", dest="trials", default=0,
+                  help="number of Monte Carlo placement-tolerance trials")
+parser.add_option("--sigma", dest="sigma", default=0.001,
+                  help="placement error (m) for the tolerance trials")
+parser.add_option("--seed", dest="seed", default=0,
+                  help="random seed for the tolerance trials")
+parser.add_option("--ranking", dest="ranking", default=None,
+                  help="write the per-coil placement sensitivity table to this file")
 
 #d=dipole(1.2,0,0,0,0,100000)  # dipole1
 #d=dipole(0,0,1.2,0,0,1)  # dipole2
 d=dipole(0,0,1.2,1,0,0)  # dipole3
 
+parser.add_option("--report", dest="report", default=None,
+                  help="save the figures into this directory with an index page instead of showing them")
 (options,args)=parser.parse_args()
 
 l=int(options.l)
@@ -652,6 +664,9 @@ print('the vector test')
 print(len(myarray.vec_b()),myarray.vec_b())
 
 import matplotlib as mpl
+if(options.report):
+    from report import headless
+    headless(options.report) # Agg backend, plt.show() saves the figures
 from mpl_toolkits.mplot3d import Axes3D
 import numpy as np
 import matplotlib.pyplot as plt
@@ -818,6 +833,7 @@ class the_matrix:
         plt.show()
 
         
+compact_coils(myset) #drop repeated and collinear points before the field sums
 mymatrix=the_matrix(myset,myarray)
 
 print('The condition number is %f'%mymatrix.condition)
@@ -1136,6 +1152,35 @@ plt.show()
 ###########################################################################################
 #Coils Deformation studies, run with -w
 
+# Monte Carlo placement tolerance and per-coil placement
+# sensitivity, on the nominal geometry
+ntrials=int(options.trials)
+if(ntrials>0 or options.ranking):
+    geom=coilgeometry.from_coilset(myset)
+    sensor_pos=np.array([sensor.pos for sensor in myarray.sensors])
+    # the ROI of this script is the sensor cube (see --zoom), or the
+    # EDM cells with --incells, as on the grid of test-onesheet.py
+    if(options.incells):
+        xr=yr=zr=np.linspace(-.5,.5,21)
+        xt,yt,zt,labels_t=edmcells().points(xr,yr,zr)
+    else:
+        xr=yr=zr=np.linspace(-a_sensors/2,a_sensors/2,11)
+        xt,yt,zt=np.meshgrid(xr,yr,zr,indexing='ij')
+    roi_points=np.stack((xt,yt,zt),axis=-1).reshape(-1,3)
+    roi_target=np.stack((bxtarget(xt,yt,zt)*np.ones(np.shape(xt)),
+                         bytarget(xt,yt,zt)*np.ones(np.shape(xt)),
+                         bztarget(xt,yt,zt)*np.ones(np.shape(xt))),axis=-1).reshape(-1,3)
+    study=tolerancestudy(geom,sensor_pos,myarray.vec_b()*calibration_factor,
+                         roi_points,roi_target*calibration_factor,currents=calibrated_vec_i)
+    if(ntrials>0):
+        tolerance_results=study.run(ntrials,float(options.sigma),seed=int(options.seed))
+        tolerance_results.print_report()
+    if(options.ranking):
+        ranking=coil_placement_sensitivity(geom,roi_points,calibrated_vec_i,sens=study.roi_sens)
+        print_ranking(ranking)
+        print_ranking(ranking,order='rank_deg')
+        write_ranking(ranking,options.ranking)
+
 # Now let's move some coils
 myset.set_currents(calibrated_vec_i)
 #myset.coil[0].move(-0.1,0,0)
@@ -7,6 +7,8 @@ Based on but not backward compatible with pipes.py created by Jeff Martin.
 
 reroute_wires(self,coils,pipe_density=14) is the function that performs the re-routing.
   - the process requires closed loops to place the re-routes, so it uses make_closed() to do that.
+  - reroute_wires_parallel() gives the same result with independent groups of coils re-routed in worker processes.
+  - pipe_density may be an arcdensity, which picks the number of points of each arc from the allowed field error in the region of interest.
   
 QuickPipes() is a list of the standard pipes for the coil, run it before reroute_wires() to populate the list of pipes to re-reoute around.
 
@@ -18,17 +20,23 @@ Process:
 3. Run pipelist.reroute(all_coil_list)
 4. the current pipes are added to newpipes, and checked for intersects and re-routed.
 5. if re-routes are made then make a larger new pipes for each re-route and repeat until no more re-routes are made.
+   reroute_wires() stops after the first pass, reroute_wires_converge() repeats until nothing changes.
 
 sparsepipe does not do the newpipe rechecking assuming no overlaps in wires.
 
 N.B.: If the same pipelist object is re-run multiple times it will recreate every re-route.
-A clear intersections code could be useful, but currently just remake the pipeslist using QuickPipes.
+pipelist.clear_intersects() forgets them, and reroute_wires_parallel()/reroute_wires_cached() always work on clean copies of the pipes.
+reroute_wires_cached() keeps re-routed coils on disk, keyed by the coils and the pipes they cross.
 '''
 import numpy as np
 from scipy.constants import mu_0, pi
 import numpy as np
 from numpy import sqrt,cos,sin
 import math
+import copy
+import hashlib
+import os
+from concurrent.futures import ProcessPoolExecutor
 
 class pipe:
     '''
@@ -121,11 +129,28 @@ class pipe:
         return False
 
 
-    def reroute_wire(self,pipe_density=4):#14):
+    def add_intersects(self,coils,coil_ind,seg_ind):
+        '''
+        records the intersecting segments seg_ind (line from point j to j+1) of the coils coils[coil_ind] in self.inters, one pipe_intersects per coil.
+        the segments must be in coil then segment order, as from segmentindex or segment_pipe_mask().
+        '''
+        if len(coil_ind) == 0:
+            return
+        starts = np.flatnonzero(np.diff(coil_ind,prepend=-1))
+        for first, last in zip(starts, np.append(starts[1:],len(coil_ind))):
+            coil = coils[coil_ind[first]]
+            coil_ints = pipe_intersects(coil)
+            for j in seg_ind[first:last]:
+                coil_ints.add_inter(coil.points[j],coil.points[j+1],j)
+            self.inters.append(coil_ints)
+
+    def reroute_wire(self,pipe_density=4,plan=None):#14):
         '''
         after pipelist:check_intersects() has been used this function will re-route around all intersections identified for this pipe.
         
         plane_min != plane_max, only re-route wires in that given plane.
+        
+        the arcs are collected in an insertionplan; if one is passed in they are left there for the caller to apply() once all pipes are done, otherwise they are applied before returning.
         '''
         
         # print("\nstart reroute_wire")
@@ -137,192 +162,75 @@ class pipe:
 
         pipenew = pipelist()#list of new pipes to check intersections based on re-routed wire paths
         #one or more coil loops or lines in a loop intersect a given pipe:
+        apply_plan = plan is None
+        if apply_plan:
+            plan = insertionplan()
         loops = []
         lines = []
+        segments = []
         delta_v = []
         planes = []
         for inter in self.inters:
             inter.coil.rerouted = inter.coil.rerouted+1 #indicate wire has been re-routed.
-            for i1p1,i1p2 in zip(inter.points1,inter.points2):
+            for i1p1,i1p2,seg in zip(inter.points1,inter.points2,inter.segments):
                 loops.append(inter.coil)
                 lines.append(np.array([i1p1,i1p2]))
+                #segment numbers from check_intersects() go stale once another pipe has changed the loop, so without a shared plan look the line up again
+                segments.append(None if apply_plan else seg)
                 delta_v.append(i1p1[self.index_v] - self.vpipe)
                 planes.append(i1p1[self.index_p])
         
-        sort_index = np.argsort(delta_v)
-
-        # print("loops =\n " , loops)
-        # print("lines =\n " , lines)
-        # print("delta_v =\n " , delta_v)
-        # print("planes =\n " , planes)
-        # print("np.argsort(delta_v) = " , np.argsort(delta_v))
-        sorting = np.argsort(delta_v)
+
+        #stable, so lines at the same height keep the order they were found in whatever else is on the pipe
+        sorting = np.argsort(delta_v,kind='stable')
         loops = np.array(loops)[sorting]
         lines = np.array(lines)[sorting]
+        segments = np.array(segments,dtype=object)[sorting]
         delta_v = np.array(delta_v)[sorting]
         planes = np.array(planes)[sorting]
-        # print("sorted")
-        # print("loops =\n " , loops)
-        # print("lines =\n " , lines)
-        # print("delta_v =\n " , delta_v)
-        # print("planes =\n " , planes)
         
+        #all the arcs around this pipe in one go, stacked wire_space apart over and under in each plane
+        wire_space = 0.0055
+        rad_add, grown = stack_offsets(delta_v,planes,wire_space)
+        arcs = batch_arcs(lines,self.hpipe,self.vpipe,self.rpipe+rad_add,self.index_h,self.index_v,pipe_density)
+        for k in range(len(lines)):
+            self.insert_arc_points(loops[k],lines[k],rad_add[k],pipe_density=pipe_density,plan=plan,segment=segments[k],arc=arcs[k])
         
-        # find all intersection lines in the same plane
+        #make new pipe to encompass newly re-routed wires in each plane
         for pl in np.unique(planes):
-            loopst = loops[pl==planes]
-            linest = lines[pl==planes]
-            delta_vt = delta_v[pl==planes]
-            # print("pipe:reroute: pl = " , pl)
-            # print("pl==planes = " , pl==planes)
-            # print("loopst.size = " , loopst.size)
-            # print("linest.size = " , linest.size)
-            # print("loopst = " , loopst)
-            # print("linest = " , linest)
-            
-            #for rerouting split into reroutes going over and under
-            loopUnder = loopst[delta_vt<=0]
-            lineUnder = linest[delta_vt<=0]
-            loopOver = loopst[delta_vt>0]
-            lineOver = linest[delta_vt>0]
-            # print("pl = " , pl)
-            # print("loopOver.size = " , loopOver.size)
-            # print("lineOver.size = " , lineOver.size)
-            # print("loopOver = " , loopOver[::-1])
-            # print("lineOver = " , lineOver[::-1])
-            wire_space = 0.0055
-            rad_add_over = 0
-            for loop,line in zip(loopOver,lineOver):
-                # print("over: loop = " , loop)
-                # print("over: len loop = " , len(loop.points))
-                # print("over: ndim loop = " , loop.points.ndim)
-                # print("over: loop = " , loop.points)
-                # print("over: line = \n" , line)
-                # print("over: rad_add_over = " , rad_add_over)
-                self.insert_arc_points(loop,line,rad_add_over,pipe_density=pipe_density)
-                rad_add_over=rad_add_over+wire_space
-                # print("over:inserted loop = " , loop.points)
-                # print()
-                # input("Press Enter to continue...")
-            # print("loopUnder.size = " , loopUnder.size)
-            # print("lineUnder.size = " , lineUnder.size)
-            # print("loopUnder = " , loopUnder[::-1])
-            # print("lineUnder = " , lineUnder[::-1])
-            rad_add_under = 0
-            for loop,line in zip(loopUnder[::-1],lineUnder[::-1]):
-                # print("under: loop = " , loop)
-                # print("under: loop = " , loop.points)
-                # print("under: line = \n" , line)
-                # print("under: rad_add_under = " , rad_add_under)
-                self.insert_arc_points(loop,line,rad_add_under,pipe_density=pipe_density)
-                rad_add_under=rad_add_under+wire_space
-                # print("under:inserted loop = " , loop.points)
-                # print()
-            #make new pipe to encompass newly re-routed wires
-            
-            if rad_add_over != 0 or rad_add_under !=0:
-                rad_add = max(rad_add_over,rad_add_under)
-                pipenew.add_pipe(self.rpipe+rad_add,
-                                 self.vpipe,
-                                 self.hpipe,
-                                 self.haxis,
-                                 self.vaxis,
-                                 line[0,self.index_p]-0.0000001,
-                                 line[0,self.index_p]+0.0000001)
-        #sorting reroutes between end points of lines
-        for loop,line in zip(loops,lines):
-            self.sort_between_ends(loop,line)
+            pipenew.add_pipe(self.rpipe+grown[pl],
+                             self.vpipe,
+                             self.hpipe,
+                             self.haxis,
+                             self.vaxis,
+                             pl-0.0000001,
+                             pl+0.0000001)
+        #the plan sorts the re-routes between the end points of each line when it is applied
+        if apply_plan:
+            plan.apply()
             
         return len(self.inters),pipenew
         
     def gen_arc_points(self,line,radius, pipe_density = 4):#14):
       '''
       taking a pipe object from pipes.py and line defined by an two points in an array of 3d points as used in patch.py, create a numpy array of a circular arc 
-      pipe_density = number of points around primary arc
+      pipe_density = number of points around primary arc, or an arcdensity
       
-      returns points to be inserted into loop.
+      returns points to be inserted into loop, starting from the end closer to the first point of the line to keep direction correct.
+      see batch_arc_points() to make many arcs at once.
       '''
-      h_around=[] #horizontal motion
-      v_around=[] #vertical motion
-      p_around=[] #in plane coordinates
-      
-      #load pipe information
-      rpipe = radius
-      hpipe = self.hpipe
-      vpipe = self.vpipe
-      index_h  = self.index_h
-      index_v  = self.index_v
-      
-      #check if re-route needs to be created
-      #if(line[0,index_v]<vpipe+rpipe and line[0,index_v]>vpipe-rpipe):
-      p_around=[line[0,self.index_p]]*pipe_density #coordinate in plane is constant
-      #start calculating 2D point locations for shortest path around pipe:
-      if(line[0,index_v]>vpipe): # if above center, go around the top side
-        # print("gen_arc_points: going over")
-        theta_start=math.atan2(line[0,index_v]-vpipe,sqrt(rpipe**2-(line[0,index_v]-vpipe)**2))
-        theta_end=math.pi-theta_start
-        theta_around=[theta_start+(theta_end-theta_start)*i/(pipe_density-1) for i in range(0,pipe_density)]
-        v_around=vpipe+rpipe*sin(theta_around)
-      else: # go around the bottom side if below or equal
-        # print("gen_arc_points: going under")
-        theta_start=math.atan2(vpipe-line[0,index_v],sqrt(rpipe**2-(line[0,index_v]-vpipe)**2))
-        theta_end=math.pi-theta_start
-        theta_around=[theta_start+(theta_end-theta_start)*i/(pipe_density-1) for i in range(0,pipe_density)]
-        v_around=vpipe-rpipe*sin(theta_around)
-      
-      h_around=hpipe+rpipe*cos(theta_around)
-      
-      #recombine into [x,y,z] points appropriately for the horizontal and vertical axes:
-      if self.haxis == "x":
-        if self.vaxis == "y":
-          new_arc = np.array([h_around, v_around, p_around])
-        if self.vaxis == "z":
-          new_arc = np.array([h_around, p_around, v_around])
-      if self.haxis == "y":
-        if self.vaxis == "x":
-          new_arc = np.array([v_around, h_around, p_around])
-        if self.vaxis == "z":
-          new_arc = np.array([p_around, h_around, v_around])
-      if self.haxis == "z":
-        if self.vaxis == "x":
-          new_arc = np.array([v_around, p_around, h_around])
-        if self.vaxis == "y":
-          new_arc = np.array([p_around, v_around, h_around])
-      new_arc = np.transpose(new_arc.reshape(3,-1))
-      
-      #return new arc ensuring start point is closer first point than second point in line to keep direction correct.
-      
-      #diagnostic checks, uncomment for testing.
-      
-      # print("line = " , line)
-      # print("rpipe = " , rpipe)
-      # print("hpipe = " , hpipe)
-      # print("vpipe = " , vpipe)
-      # print("haxis = " , self.haxis)
-      # print("vaxis = " , self.vaxis)
-      
-      # print("index_h = " , index_h)
-      # print("index_v = " , index_v)
-      # print("line[0,index_v] = " , line[0,index_v])
-      # print("line[0,index_h] = " , line[0,index_h])
-        
-      # print("h_around = " , h_around)
-      # print("v_around = " , v_around)
-      # print("p_around = " , p_around)
-      
-      # print("distance to start " , np.linalg.norm(line[0,:]-new_arc[0,:]))
-      # print("distance to end " , np.linalg.norm(line[0,:]-new_arc[-1,:]))
-      
-      
-      if(np.linalg.norm(line[0,:]-new_arc[0,:]) > np.linalg.norm(line[0,:]-new_arc[-1,:])):
-        #print("true, flipped")
-        return np.flip(new_arc,axis=0)
-      else:
-        #print("unflipped")
-        return new_arc
+      return batch_arcs(np.asarray(line)[np.newaxis],self.hpipe,self.vpipe,radius,self.index_h,self.index_v,pipe_density)[0]
     
-    def insert_arc_points(self,loop,line,rad_add,pipe_density=14):
-        new_arc = self.gen_arc_points(line=line,radius=self.rpipe+rad_add,pipe_density=pipe_density)
+    def insert_arc_points(self,loop,line,rad_add,pipe_density=14,plan=None,segment=None,arc=None):
+        '''
+        generates the arc around the pipe for the line and adds it to the insertionplan plan after point number segment of the loop.
+        without a plan the arc is inserted into loop.points directly, and sort_between_ends() must be called afterwards.
+        arc is the arc from batch_arc_points() if it was already made.
+        '''
+        if arc is None:
+            new_arc = self.gen_arc_points(line=line,radius=self.rpipe+rad_add,pipe_density=pipe_density)
+        else:
+            new_arc = arc
         
         #remove points from outside the original line from the arc
         line_start = min(line[0, self.index_h],line[-1, self.index_h])
@@ -340,6 +248,10 @@ class pipe:
             new_arc = new_arc[np.logical_and(new_arc[:,self.index_h]>line_start, new_arc[:,self.index_h]<line_end)]
             # print("new_arc shortened = " , new_arc , "\n")
         
+        if plan is not None:
+            plan.add(loop,line,self.index_h,new_arc,segment)
+            return
+        
         ind = np.where((loop.points == line[0]).all(axis=1))[0][0]
         # print("loop = " , loop)
         # print("loop.points =\n" , loop.points)
@@ -418,6 +330,149 @@ class pipe:
 
       return 1
 
+class insertionplan:
+    '''
+    Collects the arcs to insert into coil loops during a round of re-routing, and then rebuilds each loop once.
+    
+    Inserting each arc with np.insert copies the whole loop, and finding where to put it and sorting it in afterwards (sort_between_ends) both scan the loop, which is quadratic for coils with many crossings.
+    Here arcs are kept per coil and per line, by the numbers of the line's end points in coil.points.
+    apply() then sorts the arcs with any points already between the ends along the horizontal axis, starting from the first point of the line as sort_between_ends() does, and rebuilds coil.points with a single concatenation.
+    The closing point of a closed loop always stays last.
+    
+    Every arc goes into its loop once. A line left on a pipe from an earlier plane is re-routed again with the same arcs it already holds; before the plan these were sorted in a second time, so that the loop went over them twice (the same points, but up to twice the path). apply() keeps each point between the ends of a line once, leaves out arc points the loop already passes elsewhere, and raises a ValueError if a rebuilt loop passes any point more often than the loop did before (besides the same arc on each pass of a loop that runs over a line more than once), so that this cannot come back unnoticed.
+    '''
+    def __init__(self):
+        self.loops = {} #id(loop) -> (loop, {start: (end, index_h, line, [arcs])})
+        
+    def add(self,loop,line,index_h,arc,segment=None):
+        points = loop.points
+        if (segment is not None and segment+1 < len(points) and
+            np.all(points[segment] == line[0]) and np.all(points[segment+1] == line[1])):
+            start = segment
+            end = segment+1
+        else:
+            #not recorded by check_intersects() against the loop as it is now (e.g. left over on the pipe from another plane), find the line in the loop
+            start = np.where((points == line[0]).all(axis=1))[0][0]
+            if np.all(line[1] == points[-1]):
+                end = len(points)-1
+            else:
+                end = np.where((points == line[1]).all(axis=1))[0][0]
+        if id(loop) not in self.loops:
+            self.loops[id(loop)] = (loop,{})
+        lines = self.loops[id(loop)][1]
+        if start not in lines:
+            lines[start] = (end,index_h,line,[])
+        lines[start][3].append(arc)
+        
+    def new_points(self):
+        '''
+        returns {id(loop): (loop, points)} of the arc points waiting to be inserted, to be read before apply().
+        '''
+        return {key:(loop,np.concatenate([arc for end, index_h, line, arcs in lines.values() for arc in arcs]))
+                for key, (loop, lines) in self.loops.items()}
+        
+    def apply(self):
+        for loop, lines in self.loops.values():
+            pieces = []
+            last = 0
+            #only when some arc point is on the loop already is it looked for outside of its line
+            passed = rows_in(np.concatenate([arc for end, index_h, line, arcs in lines.values() for arc in arcs]),loop.points).any()
+            put = []
+            for start in sorted(lines):
+                end, index_h, line, arcs = lines[start]
+                pieces.append(loop.points[last:start+1])
+                arc_points = np.unique(np.concatenate(arcs),axis=0)
+                if passed:
+                    #an arc the loop passes elsewhere already (put in on an earlier round, next to the part of the line it was split from) is not put in again
+                    arc_points = arc_points[~rows_in(arc_points,np.concatenate([loop.points[:start+1],loop.points[end:]]))]
+                    put.append(arc_points[~rows_in(arc_points,loop.points[start+1:end])])
+                else:
+                    put.append(arc_points)
+                new = np.concatenate([loop.points[start+1:end],arc_points])
+                if len(new) > 0:
+                    #a line left on a pipe from an earlier plane has its arcs between its ends already, and they are generated again the same: each point goes in once
+                    new = np.unique(new,axis=0)
+                    new = new[new[:, index_h].argsort()]
+                    #if ascending sort is incorrect, flip to descending
+                    if(np.linalg.norm(line[0,:]-new[0,:]) > np.linalg.norm(line[0,:]-new[-1,:])):
+                        new = np.flip(new,axis=0)
+                    pieces.append(new)
+                last = max(end,start+1)
+            pieces.append(loop.points[last:])
+            points = np.concatenate(pieces)
+            #a loop running over the same line twice takes the same arc on each pass, any other point passed again is an arc put in twice
+            put = np.concatenate(put)
+            again = loop_revisits(points)-loop_revisits(loop.points)-(len(put)-len(np.unique(put,axis=0)))
+            if again > 0:
+                raise ValueError("insertionplan: the re-routed loop passes %i points twice, an arc was inserted more than once"%again)
+            loop.points = points
+        self.loops = {}
+
+def loop_revisits(points):
+    '''
+    number of points of a loop that it passes through again, the closing point of a closed loop not counted.
+    '''
+    points = np.asarray(points).reshape(-1,3)
+    closed = len(points) > 1 and np.all(points[0] == points[-1])
+    return len(points)-len(np.unique(points,axis=0))-int(closed)
+
+def wire_planes(coils,pipes,tolerance=0.00001,index=None):
+    '''
+    finds the wire planes to re-route on, the planes of the coils that hold segments crossing any of the pipes.
+    
+    for each pipe axis the segments lying flat along it are tested against the pipes with that axis with segment_crossing_mask(), all at once.
+    the coordinates of the crossing segments are then bucketed into planes with segmentindex:planes(), a new plane starting wherever two sorted coordinates are more than tolerance apart.
+    the segmentindex is built here unless one over all the coils is passed in.
+    returns the plane coordinates in increasing order, as used by pipelist:reroute_wires().
+    '''
+    if index is None:
+        index = segmentindex(coils,level=None)
+    planes = []
+    for index_p in sorted(set(p.index_p for p in pipes)):
+        flat = np.flatnonzero(abs(index.p0[:,index_p] - index.p1[:,index_p]) < 0.000001)
+        mask = segment_crossing_mask(index.segments(flat),pipe_parameters([p for p in pipes if p.index_p == index_p]))
+        planes.extend(index.planes(index_p,tolerance,found=flat[np.any(mask,axis=1)]))
+    #planes of different axes at the same coordinate are re-routed together
+    return sorted(set(float(pl) for pl in planes))
+
+def pack_groups(groups,chunks):
+    '''
+    packs the groups of coil indices from pipelist:reroute_groups() into at most chunks jobs of about equal size, largest groups first.
+    returns the jobs as lists of coil indices in increasing order.
+    '''
+    jobs = [[] for i in range(max(1,min(chunks,len(groups))))]
+    for group in sorted(groups,key=len,reverse=True):
+        min(jobs,key=len).extend(group)
+    return [sorted(part) for part in jobs if part]
+
+def reroute_key(pointsets,pipes,pipe_density,planes):
+    '''
+    hash of the coil points and the pipes (radius, position, axes and axial ends), in order, that a re-route depends on, as a hex string for pipelist:reroute_wires_cached().
+    '''
+    key = hashlib.sha1()
+    if isinstance(pipe_density,arcdensity):
+        key.update(pipe_density.key().tobytes())
+    else:
+        key.update(np.array([pipe_density],dtype=float).tobytes())
+    key.update(np.array(list(planes),dtype=float).tobytes())
+    for pipe in pipes:
+        key.update(np.array([pipe.rpipe,pipe.hpipe,pipe.vpipe,pipe.index_h,pipe.index_v,pipe.pmin,pipe.pmax],dtype=float).tobytes())
+    for points in pointsets:
+        points = np.ascontiguousarray(points,dtype=float)
+        key.update(np.array(points.shape,dtype=np.int64).tobytes())
+        key.update(points.tobytes())
+    return key.hexdigest()
+
+def _reroute_job(pipes,coils,pipe_density,planes):
+    '''
+    worker for pipelist:reroute_wires_parallel(), re-routes one chunk of closed coils on every plane with its own pipes.
+    returns (points, rerouted) for each coil of the chunk.
+    '''
+    pipes = copy.deepcopy(pipes)
+    for pl in planes:
+        pipes.reroute_plane(coils,pl,pipe_density=pipe_density)
+    return [(coil.points,coil.rerouted) for coil in coils.coils]
+
 class pipe_intersects:
     '''
     A list of lines segments from one coil that intersect the pipe to which this is attached.
@@ -427,14 +482,491 @@ class pipe_intersects:
         self.coil = coil  #mutable coil loop link
         self.points1 = [] #first point in intersecting line
         self.points2 = [] #second point in intersecting line
+        self.segments = [] #index of the first point in coil.points, or None if not known
     #def __str__(self):
     
-    def add_inter(self, point1, point2):
+    def add_inter(self, point1, point2, segment=None):
         '''
         add a line segment from the given coil for the associated pipe.s
         '''
         self.points1.append(point1)
         self.points2.append(point2)
+        self.segments.append(segment)
+
+def batch_arc_points(lines,hpipe,vpipe,radius,index_h,index_v,pipe_density=4):
+    '''
+    vectorized pipe:gen_arc_points() for many lines at once.
+    
+    lines is an (n,2,3) array of line start and end points. hpipe, vpipe, radius, index_h and index_v may be single values or have one entry per line, so the lines can go around different pipes of a pipelist in one call.
+    lines starting above the pipe centre go over it, the others under, and the coordinate along the pipe axis is kept from the line start.
+    returns an (n,pipe_density,3) array of arcs, each starting at the end nearer the line start.
+    '''
+    lines = np.asarray(lines,dtype=float).reshape(-1,2,3)
+    n = len(lines)
+    hpipe = np.broadcast_to(np.asarray(hpipe,dtype=float),(n,))
+    vpipe = np.broadcast_to(np.asarray(vpipe,dtype=float),(n,))
+    radius = np.broadcast_to(np.asarray(radius,dtype=float),(n,))
+    index_h = np.broadcast_to(np.asarray(index_h,dtype=int),(n,))
+    index_v = np.broadcast_to(np.asarray(index_v,dtype=int),(n,))
+    rows = np.arange(n)
+    line_v = lines[rows,0,index_v]
+    over = line_v > vpipe
+    #angles from the horizontal where the line height meets the circle, as in gen_arc_points()
+    theta_start = np.arctan2(np.where(over,line_v-vpipe,vpipe-line_v),sqrt(radius**2-(line_v-vpipe)**2))
+    theta_end = pi-theta_start
+    theta = theta_start[:,np.newaxis]+(theta_end-theta_start)[:,np.newaxis]*np.arange(pipe_density)/(pipe_density-1)
+    arcs = np.repeat(lines[:,:1,:],pipe_density,axis=1)
+    steps = np.arange(pipe_density)[np.newaxis,:]
+    arcs[rows[:,np.newaxis],steps,index_h[:,np.newaxis]] = hpipe[:,np.newaxis]+radius[:,np.newaxis]*cos(theta)
+    arcs[rows[:,np.newaxis],steps,index_v[:,np.newaxis]] = np.where(over[:,np.newaxis],
+                                                                     vpipe[:,np.newaxis]+radius[:,np.newaxis]*sin(theta),
+                                                                     vpipe[:,np.newaxis]-radius[:,np.newaxis]*sin(theta))
+    flip = np.linalg.norm(lines[:,0,:]-arcs[:,0,:],axis=1) > np.linalg.norm(lines[:,0,:]-arcs[:,-1,:],axis=1)
+    arcs[flip] = arcs[flip,::-1]
+    return arcs
+
+def batch_arcs(lines,hpipe,vpipe,radius,index_h,index_v,pipe_density=4):
+    '''
+    as batch_arc_points(), but pipe_density may also be an arcdensity that chooses the number of points of each arc.
+    returns a list with one (npoints,3) arc per line.
+    '''
+    if not isinstance(pipe_density,arcdensity):
+        return list(batch_arc_points(lines,hpipe,vpipe,radius,index_h,index_v,pipe_density))
+    lines = np.asarray(lines,dtype=float).reshape(-1,2,3)
+    n = len(lines)
+    params = [np.broadcast_to(np.asarray(a),(n,)) for a in (hpipe,vpipe,radius,index_h,index_v)]
+    densities = pipe_density.densities(lines,*params)
+    arcs = [None]*n
+    #one batch per number of points
+    for density in np.unique(densities):
+        same = np.flatnonzero(densities == density)
+        for k, arc in zip(same,batch_arc_points(lines[same],*[a[same] for a in params],pipe_density=density)):
+            arcs[k] = arc
+    return arcs
+
+class arcdensity:
+    '''
+    Chooses the number of points on each re-route arc from the largest field error allowed in the region of interest.
+    An arcdensity can be passed anywhere a pipe_density is taken by the re-routing functions.
+    
+    An arc of radius R and opening angle span drawn with n points is n-1 straight chords. Each chord and the arc it cuts off make a small loop of area R**2*(dtheta-sin(dtheta))/2, dtheta = span/(n-1).
+    So the chords differ from the arc by at most a dipole of moment current times the summed area, whose field at the nearest roi point, mu_0*2*m/(4*pi*d**3), is kept below tolerance.
+    The field alone lets an arc far from the roi be drawn with a few long chords, cutting up to R*(1-cos(dtheta/2)) into the space of the wires stacked around it, so each arc also gets at least the points that keep this chord depth below depth_fraction of wire_space.
+    Large arcs and arcs near the roi get many points, small arcs far from it as few as min_density.
+    
+    roi is an (npoints,3) array of the points where the field matters, e.g. the sensor positions, tolerance the allowed error in T for a wire carrying current in A.
+    wire_space is the spacing of the stacked re-routes (m), as in stack_offsets().
+    arcs and points count what was handed out, for report().
+    '''
+    def __init__(self,roi,tolerance,current=1.0,min_density=5,max_density=64,wire_space=0.0055,depth_fraction=0.05):
+        self.roi = np.asarray(roi,dtype=float).reshape(-1,3)
+        self.tolerance = tolerance
+        self.current = current
+        self.wire_space = wire_space
+        self.depth_fraction = depth_fraction
+        self.min_density = min_density
+        self.max_density = max_density
+        self.arcs = 0
+        self.points = 0
+        
+    def error(self,radius,span,distance,density):
+        '''
+        upper estimate of the field error at distance from an arc of radius and opening angle span drawn with density points.
+        '''
+        dtheta = span/(np.asarray(density)-1)
+        area = (np.asarray(density)-1)*radius**2*(dtheta-sin(dtheta))/2
+        return mu_0*2*self.current*area/(4*pi*distance**3)
+        
+    def depth_densities(self,radius,span):
+        '''
+        smallest number of points for which no chord of an arc of radius and opening angle span cuts deeper than depth_fraction*wire_space into it.
+        '''
+        depth = self.depth_fraction*self.wire_space/np.asarray(radius,dtype=float)
+        dtheta = 2*np.arccos(np.clip(1-depth,-1,1))
+        return 1+np.ceil(np.asarray(span)/np.maximum(dtheta,1e-12)).astype(int)
+        
+    def densities(self,lines,hpipe,vpipe,radius,index_h,index_v):
+        '''
+        number of arc points for each of the lines, with the arguments of batch_arc_points().
+        '''
+        lines = np.asarray(lines,dtype=float).reshape(-1,2,3)
+        n = len(lines)
+        rows = np.arange(n)
+        line_v = lines[rows,0,index_v]
+        span = pi-2*np.arctan2(abs(line_v-vpipe),sqrt(radius**2-(line_v-vpipe)**2))
+        #distance from the arc to the nearest roi point, at least a tenth of the radius
+        centres = lines[:,0,:].copy()
+        centres[rows,index_h] = hpipe
+        centres[rows,index_v] = vpipe
+        distance = np.sqrt(np.min(np.sum(np.square(centres[:,np.newaxis,:]-self.roi[np.newaxis,:,:]),axis=2),axis=1))
+        distance = np.maximum(distance-radius,0.1*radius)
+        #smallest density that meets the tolerance
+        candidates = np.arange(self.min_density,self.max_density+1)
+        ok = self.error(radius[:,np.newaxis],span[:,np.newaxis],distance[:,np.newaxis],candidates[np.newaxis,:]) <= self.tolerance
+        densities = np.where(ok.any(axis=1),candidates[np.argmax(ok,axis=1)],self.max_density)
+        #and at least the points that keep the chords close to the arc
+        densities = np.minimum(np.maximum(densities,self.depth_densities(radius,span)),self.max_density)
+        self.arcs = self.arcs+n
+        self.points = self.points+int(densities.sum())
+        return densities
+        
+    def key(self):
+        '''
+        the settings as an array of floats, for reroute_key().
+        '''
+        return np.concatenate(([self.tolerance,self.current,self.min_density,self.max_density,self.wire_space,self.depth_fraction],self.roi.ravel()))
+        
+    def report(self,pipe_density=14):
+        '''
+        prints the number of arc points used, against a fixed pipe_density for every arc.
+        '''
+        print("arcdensity: %i arcs, %i points (%.1f per arc) for %.3g T at %.3g A; %i points at a fixed %i per arc"%(
+            self.arcs,self.points,self.points/max(self.arcs,1),self.tolerance,self.current,self.arcs*pipe_density,pipe_density))
+
+def stack_offsets(delta_v,planes,wire_space=0.0055):
+    '''
+    radius added to each of the lines going around one pipe, so that the re-routes in the same plane stack wire_space apart as in pipe:reroute_wire().
+    
+    delta_v is the height of each line above the pipe centre and planes its coordinate along the pipe axis.
+    lines going over (delta_v > 0) stack outward from the lowest one, lines going under from the highest one, with lines at the same height in their given order.
+    returns rad_add for each line, and the largest stack in each plane as a dict {plane: rad_add} for the pipe grown around it.
+    '''
+    delta_v = np.asarray(delta_v,dtype=float)
+    planes = np.asarray(planes,dtype=float)
+    n = len(delta_v)
+    over = delta_v > 0
+    plane_values, plane_ind = np.unique(planes,return_inverse=True)
+    group = 2*plane_ind.reshape(-1)+over
+    #position of each line in its group, counted up the heights
+    sorting = np.argsort(delta_v,kind='stable')
+    by_group = sorting[np.argsort(group[sorting],kind='stable')]
+    sorted_groups = group[by_group]
+    rank = np.empty(n,dtype=int)
+    rank[by_group] = np.arange(n)-np.searchsorted(sorted_groups,sorted_groups,side='left')
+    counts = np.bincount(group,minlength=2*len(plane_values))
+    rank = np.where(over,rank,counts[group]-1-rank)
+    #summed one wire_space at a time as the loop in reroute_wire() did
+    offsets = np.concatenate(([0.0],np.cumsum(np.full(max(counts.max(initial=0),1),wire_space))))
+    grown = {pl:max(offsets[counts[2*k+1]],offsets[counts[2*k]]) for k, pl in enumerate(plane_values)}
+    return offsets[rank], grown
+
+def pipe_parameters(pipes):
+    '''
+    collects the parameters of a list of pipes into arrays with one entry per pipe, for segment_pipe_mask().
+    '''
+    return {'rpipe':np.array([p.rpipe for p in pipes],dtype=float),
+            'hpipe':np.array([p.hpipe for p in pipes],dtype=float),
+            'vpipe':np.array([p.vpipe for p in pipes],dtype=float),
+            'pmin':np.array([p.pmin for p in pipes],dtype=float),
+            'pmax':np.array([p.pmax for p in pipes],dtype=float),
+            'index_h':np.array([p.index_h for p in pipes],dtype=int),
+            'index_v':np.array([p.index_v for p in pipes],dtype=int),
+            'index_p':np.array([p.index_p for p in pipes],dtype=int)}
+
+def segment_pipe_mask(segments,params,plane=None):
+    '''
+    vectorized pipe:check_intersect() for many segments and many pipes at once.
+    
+    segments is an (nseg,2,3) array of line start and end points, params is from pipe_parameters().
+    If plane is given the segment must also start in that plane, as in pipelist:check_intersects().
+    returns an (nseg,npipes) boolean array, true where the segment intersects the pipe.
+    '''
+    segments = np.asarray(segments,dtype=float).reshape(-1,2,3)
+    p0 = segments[:,0,:]
+    p1 = segments[:,1,:]
+    #coordinates of each segment along each pipe's axes, (nseg,npipes)
+    p0_p = p0[:,params['index_p']]
+    p1_p = p1[:,params['index_p']]
+    p0_v = p0[:,params['index_v']]
+    mask = ~np.all(p0 == p1,axis=1)[:,np.newaxis] #repeated points never intersect
+    mask = mask & (abs(p0_p - p1_p) < 0.000001) #flat in the plane
+    mask = mask & (p0_p >= params['pmin']) & (p0_p <= params['pmax']) #within the axial ends
+    mask = mask & (p0_v < params['vpipe']+params['rpipe']) & (p0_v > params['vpipe']-params['rpipe']) #height within the radius
+    if plane is not None:
+        mask = mask & (abs(p0_p - plane) < 0.00001)
+    return mask
+
+def segment_crossing_mask(segments,params,plane=None):
+    '''
+    stricter test than segment_pipe_mask() used by pipelist:reroute_plane_converge() after the first round.
+    
+    the segment must lie flat in the plane and along the pipe horizontal axis, pass the pipe centre horizontally within the radius, and have both ends outside the pipe.
+    the arcs already routed around a pipe lie inside the larger pipe grown around them, so they do not flag it again.
+    returns an (nseg,npipes) boolean array, true where the segment crosses the pipe.
+    '''
+    segments = np.asarray(segments,dtype=float).reshape(-1,2,3)
+    p0 = segments[:,0,:]
+    p1 = segments[:,1,:]
+    p0_p = p0[:,params['index_p']]
+    p0_v = p0[:,params['index_v']]
+    p1_v = p1[:,params['index_v']]
+    p0_h = p0[:,params['index_h']]
+    p1_h = p1[:,params['index_h']]
+    mask = abs(p0_p - p1[:,params['index_p']]) < 0.000001 #flat in the plane
+    mask = mask & (abs(p0_v - p1_v) < 0.000001) #along the horizontal axis
+    mask = mask & (p0_p >= params['pmin']) & (p0_p <= params['pmax'])
+    mask = mask & (p0_v < params['vpipe']+params['rpipe']) & (p0_v > params['vpipe']-params['rpipe'])
+    mask = mask & (np.minimum(p0_h,p1_h) < params['hpipe']) & (np.maximum(p0_h,p1_h) > params['hpipe'])
+    rsq = np.square(params['rpipe'])
+    mask = mask & (np.square(p0_h-params['hpipe'])+np.square(p0_v-params['vpipe']) >= rsq)
+    mask = mask & (np.square(p1_h-params['hpipe'])+np.square(p1_v-params['vpipe']) >= rsq)
+    if plane is not None:
+        mask = mask & (abs(p0_p - plane) < 0.00001)
+    return mask
+
+def rows_in(points,others):
+    '''
+    boolean array, true for each row of the (n,3) array points that is also a row of others.
+    '''
+    points = np.ascontiguousarray(points,dtype=float)
+    others = np.ascontiguousarray(others,dtype=float)
+    row = np.dtype((np.void,points.dtype.itemsize*3))
+    return np.isin(points.view(row).ravel(),others.view(row).ravel())
+
+def segment_pair_distances(p0,p1,q0,q1):
+    '''
+    shortest distance between each segment p0->p1 and the segment q0->q1 on the same row, all (n,3) arrays.
+    '''
+    d1 = p1-p0
+    d2 = q1-q0
+    r = p0-q0
+    a = np.sum(d1*d1,axis=1)
+    e = np.sum(d2*d2,axis=1)
+    f = np.sum(d2*r,axis=1)
+    c = np.sum(d1*r,axis=1)
+    b = np.sum(d1*d2,axis=1)
+    denom = a*e-b*b
+    with np.errstate(invalid='ignore',divide='ignore'):
+        #closest point on the first segment to the second line, any point for parallel lines
+        s = np.where((denom > 1e-12*a*e) & (a > 0),np.clip((b*f-c*e)/denom,0,1),0.0)
+        t = np.where(e > 0,(b*s+f)/e,0.0)
+        #if that is off the second segment, take its nearer end and the closest point to it on the first segment
+        t = np.clip(t,0,1)
+        s = np.where(a > 0,np.clip((b*t-c)/a,0,1),0.0)
+    return np.linalg.norm(p0+d1*s[:,np.newaxis]-q0-d2*t[:,np.newaxis],axis=1)
+
+#one row per pair of segments closer than the clearance, see wire_clearance()
+clearance_dtype = [('coil1',int),('segment1',int),('coil2',int),('segment2',int),('distance',float)]
+
+def wire_clearance(coils,clearance=0.005,cell=None,same_coil=False):
+    '''
+    finds the pairs of wire segments of different coils that come closer than clearance, e.g. after re-routing.
+    
+    the segments are cut into pieces about a cell long and hashed into a uniform grid of cubes of side cell (by default the larger of twice the clearance and the median segment length), each piece into every cell its bounding box grown by clearance touches.
+    only pieces sharing a cell are compared, with the exact segment to segment distance.
+    same_coil=True also checks the segments of one coil against each other, except for neighbours sharing a point.
+    returns an array of clearance_dtype sorted by distance.
+    '''
+    p0 = []
+    p1 = []
+    coil_ind = []
+    seg_ind = []
+    for ci, coil in enumerate(coils.coils):
+        points = np.asarray(coil.points,dtype=float)
+        if len(points) < 2:
+            continue
+        #the coil points are an open list closed by the last point joining the first
+        p0.append(points)
+        p1.append(np.roll(points,-1,axis=0))
+        coil_ind.append(np.full(len(points),ci))
+        seg_ind.append(np.arange(len(points)))
+    if not p0:
+        return np.zeros(0,dtype=clearance_dtype)
+    p0 = np.concatenate(p0)
+    p1 = np.concatenate(p1)
+    coil_ind = np.concatenate(coil_ind)
+    seg_ind = np.concatenate(seg_ind)
+    keep = np.any(p0 != p1,axis=1)
+    p0, p1, coil_ind, seg_ind = p0[keep], p1[keep], coil_ind[keep], seg_ind[keep]
+    nseg = len(p0)
+    if cell is None:
+        cell = max(2*clearance,np.median(np.linalg.norm(p1-p0,axis=1)))
+        
+    #long segments are cut into pieces about a cell long, so that a diagonal wire does not fill every cell of its bounding box
+    length = np.linalg.norm(p1-p0,axis=1)
+    npieces = np.maximum(np.ceil(length/cell),1).astype(np.int64)
+    piece_owner = np.repeat(np.arange(nseg),npieces)
+    piece = (np.arange(npieces.sum())-np.repeat(np.cumsum(npieces)-npieces,npieces))[:,None]
+    direction = ((p1-p0)/npieces[:,None])[piece_owner]
+    q0 = p0[piece_owner]+piece*direction
+    q1 = q0+direction
+    
+    #cells covered by each piece's grown bounding box
+    lo = np.floor((np.minimum(q0,q1)-clearance/2)/cell).astype(np.int64)
+    hi = np.floor((np.maximum(q0,q1)+clearance/2)/cell).astype(np.int64)
+    span = hi-lo+1
+    counts = np.prod(span,axis=1)
+    owner = np.repeat(np.arange(len(q0)),counts)
+    step = np.arange(counts.sum())-np.repeat(np.cumsum(counts)-counts,counts)
+    ix = lo[owner,0]+step % span[owner,0]
+    iy = lo[owner,1]+(step//span[owner,0]) % span[owner,1]
+    iz = lo[owner,2]+step//(span[owner,0]*span[owner,1])
+    #one integer per cell
+    cells = np.stack((ix,iy,iz),axis=1)
+    shifted = cells-cells.min(axis=0)
+    size = shifted.max(axis=0)+1
+    key = (shifted[:,0]*size[1]+shifted[:,1])*size[2]+shifted[:,2]
+    order = np.argsort(key,kind='stable')
+    key = key[order]
+    owner = owner[order]
+    cells = cells[order]
+    
+    #every pair of entries in the same cell: each entry with the ones after it in its cell
+    start = np.flatnonzero(np.diff(key,prepend=key[0]-1))
+    size = np.diff(np.append(start,len(key)))
+    position = np.arange(len(key))-np.repeat(start,size)
+    npairs = np.repeat(size,size)-1-position
+    if npairs.sum() == 0:
+        return np.zeros(0,dtype=clearance_dtype)
+    first = np.repeat(np.arange(len(key)),npairs)
+    second = first+1+np.arange(npairs.sum())-np.repeat(np.cumsum(npairs)-npairs,npairs)
+    #two pieces can share several cells, count them only in the cell at the low corner of the overlap of their boxes
+    corner = np.all(cells[first] == np.maximum(lo[owner[first]],lo[owner[second]]),axis=1)
+    first_piece = owner[first[corner]]
+    second_piece = owner[second[corner]]
+    first = piece_owner[first_piece]
+    second = piece_owner[second_piece]
+    if same_coil:
+        #neighbours share a point, so their distance is zero
+        keep = first != second
+        for a, b in ((first,second),(second,first)):
+            keep = keep & ~((coil_ind[a] == coil_ind[b]) & (np.all(p1[a] == p0[b],axis=1) | np.all(p0[a] == p0[b],axis=1) | np.all(p1[a] == p1[b],axis=1)))
+    else:
+        keep = coil_ind[first] != coil_ind[second]
+    first, second = first[keep], second[keep]
+    first_piece, second_piece = first_piece[keep], second_piece[keep]
+    
+    #the distance of two segments is the smallest distance of their pieces
+    distance = segment_pair_distances(q0[first_piece],q1[first_piece],q0[second_piece],q1[second_piece])
+    close = np.flatnonzero(distance < clearance)
+    close = close[np.argsort(distance[close],kind='stable')]
+    pair = np.minimum(first[close],second[close])*nseg+np.maximum(first[close],second[close])
+    close = close[np.sort(np.unique(pair,return_index=True)[1])]
+    result = np.zeros(len(close),dtype=clearance_dtype)
+    result['coil1'] = coil_ind[first[close]]
+    result['segment1'] = seg_ind[first[close]]
+    result['coil2'] = coil_ind[second[close]]
+    result['segment2'] = seg_ind[second[close]]
+    result['distance'] = distance[close]
+    return result
+
+def print_clearance(violations,clearance=None,n=20):
+    '''
+    prints the closest pairs of coils from wire_clearance(), one line per pair of coils at their smallest distance.
+    '''
+    pairs = {}
+    for v in violations:
+        key = (min(v['coil1'],v['coil2']),max(v['coil1'],v['coil2']))
+        pairs[key] = pairs.get(key,0)+1
+    limit = "" if clearance is None else " closer than %.4f m"%clearance
+    print("wire clearance: %i segment pairs%s between %i pairs of coils"%(len(violations),limit,len(pairs)))
+    shown = set()
+    for v in violations:
+        key = (min(v['coil1'],v['coil2']),max(v['coil1'],v['coil2']))
+        if key in shown:
+            continue
+        shown.add(key)
+        print("   coils %4i and %4i: %3i segment pairs, closest %.5f m (segments %i and %i)"%(key[0],key[1],pairs[key],v['distance'],v['segment1'],v['segment2']))
+        if len(shown) >= n:
+            break
+
+class segmentindex:
+    '''
+    Spatial index over the line segments of a coilset, used by pipelist:check_intersects() so that each pipe only tests the segments that can hit it.
+    
+    Only segments of coils with coil.rerouted == level are indexed (all coils if level is None), with zero length segments dropped.
+    Segments are bucketed by the plane they lie flat in (the pipe axis index_p and the plane coordinate), and within a bucket sorted by their coordinate along the pipe vertical axis index_v.
+    A pipe then reads the segments whose height is within its radius with a binary search.
+    '''
+    def __init__(self,coils,level=0):
+        self.coils = coils.coils
+        p0 = []
+        p1 = []
+        coil_ind = []
+        seg_ind = []
+        for ci, coil in enumerate(coils.coils):
+            if level is not None and coil.rerouted != level:
+                continue
+            points = np.asarray(coil.points)
+            if len(points) < 2:
+                continue
+            p0.append(points[:-1])
+            p1.append(points[1:])
+            coil_ind.append(np.full(len(points)-1,ci))
+            seg_ind.append(np.arange(len(points)-1))
+        if p0:
+            self.p0 = np.concatenate(p0)
+            self.p1 = np.concatenate(p1)
+            self.coil_ind = np.concatenate(coil_ind)
+            self.seg_ind = np.concatenate(seg_ind)
+        else:
+            self.p0 = np.zeros((0,3))
+            self.p1 = np.zeros((0,3))
+            self.coil_ind = np.zeros(0,dtype=int)
+            self.seg_ind = np.zeros(0,dtype=int)
+        #repeated points never intersect
+        keep = ~np.all(self.p0 == self.p1,axis=1)
+        self.p0 = self.p0[keep]
+        self.p1 = self.p1[keep]
+        self.coil_ind = self.coil_ind[keep]
+        self.seg_ind = self.seg_ind[keep]
+        self.buckets = {} #(index_p,index_v,plane) -> (segment numbers sorted by height, their heights)
+        
+    def bucket(self,index_p,index_v,plane):
+        key = (index_p,index_v,plane)
+        if key not in self.buckets:
+            #same tolerances as check_intersects() and pipe:check_intersect()
+            inplane = np.flatnonzero((abs(self.p0[:,index_p] - plane) < 0.00001) &
+                                     (abs(self.p0[:,index_p] - self.p1[:,index_p]) < 0.000001))
+            order = inplane[np.argsort(self.p0[inplane,index_v],kind='stable')]
+            self.buckets[key] = (order,self.p0[order,index_v])
+        return self.buckets[key]
+        
+    def planes(self,index_p,tolerance=0.00001,found=slice(None)):
+        '''
+        returns the coordinates along axis index_p of the planes the segments (only the segment numbers found if given) lie flat in, in increasing order.
+        coordinates less than tolerance apart are one plane, given by the middle of its range.
+        '''
+        p0 = self.p0[found]
+        flat = abs(p0[:,index_p] - self.p1[found][:,index_p]) < 0.000001
+        coords = np.sort(p0[flat,index_p])
+        if len(coords) == 0:
+            return []
+        start = np.flatnonzero(np.diff(coords,prepend=coords[0]-2*tolerance) > tolerance)
+        end = np.append(start[1:],len(coords))-1
+        return list((coords[start]+coords[end])/2)
+        
+    def candidates(self,pipe,plane):
+        '''
+        returns the segment numbers that intersect the pipe in the given plane, in coil then segment order.
+        '''
+        found = self.near(pipe,plane)
+        return found[segment_pipe_mask(self.segments(found),pipe_parameters([pipe]))[:,0]]
+        
+    def crossings(self,pipe,plane,among=None):
+        '''
+        as candidates() but with segment_crossing_mask(), and only for the segments where the boolean array among is true if it is given.
+        '''
+        found = self.near(pipe,plane)
+        if among is not None:
+            found = found[among[found]]
+        return found[segment_crossing_mask(self.segments(found),pipe_parameters([pipe]))[:,0]]
+        
+    def near(self,pipe,plane):
+        '''
+        segment numbers in the plane whose starting height is within the pipe radius, in coil then segment order.
+        '''
+        order, heights = self.bucket(pipe.index_p,pipe.index_v,plane)
+        lo = np.searchsorted(heights,pipe.vpipe-pipe.rpipe,side='right')
+        hi = np.searchsorted(heights,pipe.vpipe+pipe.rpipe,side='left')
+        #segments were stored coil by coil, so the numbers give the original order
+        return np.sort(order[lo:hi])
+        
+    def segments(self,found=slice(None)):
+        '''
+        the indexed segments as an (nseg,2,3) array
+        '''
+        return np.stack((self.p0[found],self.p1[found]),axis=1)
 
 class pipelist:
     '''
@@ -537,102 +1069,331 @@ class pipelist:
         self.draw_pipes(ax3[3],**plt_kwargs)
         return ax3
 
-    def check_intersects(self,coils,level=0,plane=0):
+    def check_intersects(self,coils,level=0,plane=0,index=None):
         '''
         for each coil go through all pipe and for each coil loop in a coil set (coils) add intersect to each pipe
+        
+        the segments are looked up through a segmentindex, built here unless one for the same coils and level is passed in.
         '''
         # print("Starting pipelist:check_intersects of ", len(self.pipes), " pipes.")
-        for index, pipe in enumerate(self.pipes):
-            # print("pipelist:check_intersects: pipe " , index," of ", len(self.pipes))
-            # print("pipelist:check_intersects: Total Coils = " ,len(coils.coils))
-            for index, coil in enumerate(coils.coils):
-                # if index%5 ==0:#uncomment to print current coils coil being processed.
-                    # print(index,end=" ")
-                # print("coil = " , coil)
-                # print("coil.rerouted = " , coil.rerouted)
-                if coil.rerouted == level:
-                    add_flag = False
-                    coil_ints = pipe_intersects(coil)
-                    for j in range(len(coil.points)-1): #for closed loops
-                        line = [coil.points[j],coil.points[j+1]]
-                        # print("      line[0] = " , line[0])
-                        # print("      line[1] = " , line[1])
-                        if abs(line[0][pipe.index_p] - plane)<0.00001:
-                            if np.all(line[0] == line[1]):
-                                continue #skip repeated points
-                            if pipe.check_intersect(np.array(line)):
-                                # print("      intersection found")
-                                add_flag = True
-                                coil_ints.add_inter(line[0],line[1])
-                        # else:
-                            # print("Wrong Plane")
-                    if add_flag:
-                        pipe.inters.append(coil_ints)
-                        # print("        check_intersects: pipe.inters added")
+        if index is None:
+            index = segmentindex(coils,level)
+        for pipe in self.pipes:
+            found = index.candidates(pipe,plane)
+            pipe.add_intersects(index.coils,index.coil_ind[found],index.seg_ind[found])
     
-    def reroute_wires(self,coils,pipe_density=14):
+    def check_intersects_broadcast(self,coils,level=0,plane=0):
+        '''
+        same as check_intersects(), but tests every segment against every pipe in one segment_pipe_mask() call.
+        for a few pipes and many segments this avoids the per pipe index lookups.
+        '''
+        index = segmentindex(coils,level)
+        mask = segment_pipe_mask(index.segments(),pipe_parameters(self.pipes),plane)
+        for k, pipe in enumerate(self.pipes):
+            found = np.flatnonzero(mask[:,k])
+            pipe.add_intersects(index.coils,index.coil_ind[found],index.seg_ind[found])
+    
+    def reroute_wires(self,coils,pipe_density=14,planes=None):
         '''
         performs the re-routing for all pipes that have flagged intersects from check_intersects that must be run first.
-        -!-!-!-!-!- note: the wire planes to reroute on must be set here.
-        -!-!-!-!-!- changing the coil size requires the planes to be changed as well.
+        the wire planes to reroute on are found with wire_planes() unless planes is given.
         '''
         # print("pipelist:reroutewires - starting fuction")
         #clean up coils to prepare for checking for intersections
         coils.make_closed() #first and last point in last made the same if not already
         coils.round_all() #round some decimal places for easier float comparisons
+        if planes is None:
+            planes = wire_planes(coils,self.pipes)
         
         #pl sets the plane positions to check for re-routes along the plane perpendicular to the axis of each cylindrical pipe.
         #I think this was done to prevent secondary re-routes from occuring on planes that don't contact each other.
         
         # for pl in [-1.906/2-0.087, -1.906/2, 1.906/2, 1.906/2+0.087,1.01]:
         # print("      pipelist.reroute_wires() - starting planes iteration: plane=", end =" ")
-        for pl in [-2.1102/2, -1.9202/2, 1.9202/2, 2.1102/2]:#curent good
+        for pl in planes:#curent good
         # for pl in [2.1102/2]:
             # print(pl ,end= " , ")
-            #reset variables for new plane.
-            newpipes = [] # list of larger pipes for rerouting around re-routes
-            for coil in coils.coils:
-                coil.rerouted=0
-            newpipes.append(self)
-            go_on = True
-            counter = 0
-            
-            #reroute wires and continue to do so until a rerouting makes no changes.
-            while go_on:
-                # print("pipelist:reroutewires - starting go_on loop")
-                # print("- - - -pl = " , pl , ":  start loop = " , counter , "\n\n")
-                newpipes[-1].check_intersects(coils, level = 0,plane = pl)
-                
-                temp = pipelist()
-                changes = 0 #track how many lines are changed
-                # print("newpipes[-1] = " , newpipes[-1])
-                for index, pipe in enumerate(newpipes[-1].pipes):
-                    # print("pipelist:reroute_wires- enumerate newpipes " , index, " of " , len(self.pipes)-1)
-                    # print("   pipe = " , pipe)
-                    total_reroutes, temppipes = pipe.reroute_wire(pipe_density=pipe_density)
-                    changes = changes + total_reroutes
-                    # print("      Total Reroutes:" , total_reroutes)
-                    if temppipes != 0:
-                        temp.join_lists(temppipes)
-                newpipes.append(temp)
-                counter = counter+1
-                go_on = False #uncomment this line to only do the first resets
-                if changes == 0: go_on = False
-                coils.remove_duplicate_points()
+            self.reroute_plane(coils,pl,pipe_density=pipe_density)
         #clean up after re-routing as coils are usually an open list assumed to be a closed loop.
         coils.remove_duplicate_points()
         coils.make_open()
         # print("  re-routes done.")
         
-    def reroute_wires2(self,coils,pipe_density=14,planes=[-1.906/2-0.087, -1.906/2, 1.906/2, 1.906/2+0.087,1.01]):
+    def reroute_plane(self,coils,pl,pipe_density=14):
+        '''
+        re-routes the wires of coils in the plane pl, the body of reroute_wires() for one plane.
+        coils must already be closed and rounded.
+        '''
+        #reset variables for new plane.
+        newpipes = [] # list of larger pipes for rerouting around re-routes
+        for coil in coils.coils:
+            coil.rerouted=0
+        newpipes.append(self)
+        go_on = True
+        counter = 0
+            
+        #reroute wires and continue to do so until a rerouting makes no changes.
+        while go_on:
+            # print("pipelist:reroutewires - starting go_on loop")
+            # print("- - - -pl = " , pl , ":  start loop = " , counter , "\n\n")
+            newpipes[-1].check_intersects(coils, level = 0,plane = pl)
+                
+            temp = pipelist()
+            plan = insertionplan() #all arcs of this round, inserted once the pipes are done
+            changes = 0 #track how many lines are changed
+            # print("newpipes[-1] = " , newpipes[-1])
+            for index, pipe in enumerate(newpipes[-1].pipes):
+                # print("pipelist:reroute_wires- enumerate newpipes " , index, " of " , len(self.pipes)-1)
+                # print("   pipe = " , pipe)
+                total_reroutes, temppipes = pipe.reroute_wire(pipe_density=pipe_density,plan=plan)
+                changes = changes + total_reroutes
+                # print("      Total Reroutes:" , total_reroutes)
+                if temppipes != 0:
+                    temp.join_lists(temppipes)
+            plan.apply()
+            newpipes.append(temp)
+            counter = counter+1
+            go_on = False #uncomment this line to only do the first resets
+            if changes == 0: go_on = False
+            coils.remove_duplicate_points()
+        
+    def reroute_plane_converge(self,coils,pl,pipe_density=14,max_rounds=20):
+        '''
+        re-routes the wires of coils in the plane pl as reroute_plane() does, then keeps re-routing around the larger pipes grown around each bundle of re-routes until no new crossings are found.
+        
+        the first round is reroute_plane(). After it only the pairs not checked before are tested, with segment_crossing_mask():
+          - every segment against the pipes grown in the previous round,
+          - the segments created in the previous round against all the earlier pipes.
+        coils must already be closed and rounded.
+        returns one (round, new segments, pipes checked, crossings, pipes grown) tuple per round, where the new segments of the first round are all of them.
+        '''
+        for coil in coils.coils:
+            coil.rerouted=0
+        counts = []
+        allpipes = pipelist() #the pipes and every pipe grown so far
+        allpipes.pipes = list(self.pipes)
+        newpipes = self
+        created = {} #id(coil) -> arc points inserted in the previous round
+        for counter in range(max_rounds):
+            if counter == 0:
+                newpipes.check_intersects(coils, level = 0,plane = pl)
+                nsegs = sum(max(len(coil.points)-1,0) for coil in coils.coils)
+                npipes = len(newpipes.pipes)
+            else:
+                index = segmentindex(coils,level=None)
+                #segments with an end on an arc inserted in the previous round
+                new = np.zeros(len(index.coil_ind),dtype=bool)
+                bounds = np.searchsorted(index.coil_ind,np.arange(len(coils.coils)+1))
+                for ci, coil in enumerate(coils.coils):
+                    if id(coil) in created:
+                        fresh = rows_in(coil.points,created[id(coil)])
+                        segs = index.seg_ind[bounds[ci]:bounds[ci+1]]
+                        new[bounds[ci]:bounds[ci+1]] = fresh[segs] | fresh[segs+1]
+                older = allpipes.pipes[:len(allpipes.pipes)-len(newpipes.pipes)]
+                for pipe in newpipes.pipes:
+                    found = index.crossings(pipe,pl)
+                    pipe.add_intersects(index.coils,index.coil_ind[found],index.seg_ind[found])
+                if np.any(new):
+                    for pipe in older:
+                        found = index.crossings(pipe,pl,among=new)
+                        pipe.add_intersects(index.coils,index.coil_ind[found],index.seg_ind[found])
+                newpipes = pipelist()
+                newpipes.pipes = [pipe for pipe in allpipes.pipes if len(pipe.inters)]
+                nsegs = np.count_nonzero(new)
+                npipes = len(allpipes.pipes)-len(older) + (len(older) if np.any(new) else 0)
+                
+            temp = pipelist()
+            plan = insertionplan()
+            changes = 0
+            for pipe in newpipes.pipes:
+                total_reroutes, temppipes = pipe.reroute_wire(pipe_density=pipe_density,plan=plan)
+                changes = changes + total_reroutes
+                if temppipes != 0:
+                    temp.join_lists(temppipes)
+            created = {key:points for key, (loop, points) in plan.new_points().items()}
+            plan.apply()
+            coils.remove_duplicate_points()
+            counts.append((counter,nsegs,npipes,changes,len(temp.pipes)))
+            #later rounds only look at what this round changed, so the intersects are spent
+            allpipes.clear_intersects()
+            if changes == 0 or len(temp.pipes) == 0:
+                break
+            allpipes.pipes.extend(temp.pipes)
+            newpipes = pipelist()
+            newpipes.pipes = allpipes.pipes[len(allpipes.pipes)-len(temp.pipes):]
+        else:
+            print("pipelist.reroute_plane_converge: plane %f still changing after %i rounds"%(pl,max_rounds))
+        return counts
+        
+    def reroute_wires_converge(self,coils,pipe_density=14,planes=None,max_rounds=20,verbose=True,clearance=None):
+        '''
+        same as reroute_wires() but each plane is re-routed with reroute_plane_converge(), so wires that meet the bundles of re-routed wires are re-routed around them too.
+        returns {plane: per round counts} and prints them if verbose.
+        if clearance is given the wires are checked with wire_clearance() after each plane and the violations printed.
+        '''
+        coils.make_closed()
+        coils.round_all()
+        if planes is None:
+            planes = wire_planes(coils,self.pipes)
+        counts = {}
+        for pl in planes:
+            counts[pl] = self.reroute_plane_converge(coils,pl,pipe_density=pipe_density,max_rounds=max_rounds)
+            if verbose:
+                for counter, nsegs, npipes, changes, grown in counts[pl]:
+                    print("plane %8.4f round %2i: %6i new segments, %4i pipes checked, %4i crossings re-routed, %4i pipes grown"%(pl,counter,nsegs,npipes,changes,grown))
+            if clearance is not None:
+                print_clearance(wire_clearance(coils,clearance),clearance,n=5)
+        coils.remove_duplicate_points()
+        coils.make_open()
+        return counts
+        
+    def clear_intersects(self):
+        '''
+        forgets the intersects found by check_intersects(), so the pipes can be used again without re-creating the old re-routes.
+        '''
+        for pipe in self.pipes:
+            pipe.inters = []
+        
+    def reroute_wires_parallel(self,coils,pipe_density=14,planes=None,workers=None,chunks=None):
+        '''
+        same result as reroute_wires(), with the coils split into chunks that are re-routed in a pool of worker processes.
+        
+        coils that cross the same pipe in the same plane are stacked around it with wire_space between them, so they are kept in one chunk (see reroute_groups()).
+        each chunk runs every plane against its own copy of the pipes with the intersects cleared, and the re-routed points are written back by coil index so the result does not depend on the order the chunks finish in.
+        workers=1 runs the chunks in this process, chunks defaults to four per worker.
+        '''
+        coils.make_closed()
+        coils.round_all()
+        if planes is None:
+            planes = wire_planes(coils,self.pipes)
+        if workers is None:
+            workers = os.cpu_count() or 1
+        if chunks is None:
+            chunks = 4*workers
+        self.reroute_jobs(coils,pack_groups(self.reroute_groups(coils,planes),chunks),pipe_density,planes,workers)
+        coils.remove_duplicate_points()
+        coils.make_open()
+        
+    def reroute_wires_cached(self,coils,cache_dir,pipe_density=14,planes=None,workers=1,chunks=None):
+        '''
+        same result as reroute_wires(), with the re-routed coils kept in cache_dir so that re-running with the same pipes and coils loads them instead.
+        
+        the cache holds one file per group of coils from reroute_groups(), named by reroute_key() of the group's coils and the pipes they cross.
+        changing, adding or removing a pipe only re-routes the groups of coils that cross it, and coils that cross no pipe are neither re-routed nor cached.
+        the pipes are used through clean copies, so unlike reroute_wires() this can be run again with the same pipelist.
+        the groups that are not in the cache are re-routed as in reroute_wires_parallel().
+        returns the number of groups loaded from the cache and the number re-routed.
+        '''
+        if chunks is None:
+            chunks = 4*max(1,workers)
+        coils.make_closed()
+        coils.round_all()
+        if planes is None:
+            planes = wire_planes(coils,self.pipes)
+        os.makedirs(cache_dir,exist_ok=True)
+        groups, group_pipes = self.reroute_groups(coils,planes,pipes=True)
+        missing = []
+        for group, crossed in zip(groups,group_pipes):
+            if len(crossed) == 0:
+                for i in group:
+                    coils.coils[i].rerouted = 0
+                continue
+            name = os.path.join(cache_dir,reroute_key([coils.coils[i].points for i in group],
+                                                      [self.pipes[k] for k in crossed],pipe_density,planes)+'.npz')
+            if os.path.exists(name):
+                with np.load(name) as data:
+                    for j, i in enumerate(group):
+                        coils.coils[i].points = data['points%i'%j]
+                        coils.coils[i].rerouted = int(data['rerouted'][j])
+            else:
+                missing.append((group,name))
+        self.reroute_jobs(coils,pack_groups([group for group, name in missing],chunks),pipe_density,planes,workers)
+        for group, name in missing:
+            arrays = {'points%i'%j:coils.coils[i].points for j, i in enumerate(group)}
+            arrays['rerouted'] = np.array([coils.coils[i].rerouted for i in group],dtype=int)
+            #write to a temporary name first so an interrupted run never leaves a broken entry
+            with open(name+'.tmp','wb') as f:
+                np.savez(f,**arrays)
+            os.replace(name+'.tmp',name)
+        coils.remove_duplicate_points()
+        coils.make_open()
+        return sum(len(crossed) > 0 for crossed in group_pipes)-len(missing), len(missing)
+        
+    def reroute_jobs(self,coils,jobs,pipe_density=14,planes=None,workers=1):
+        '''
+        re-routes each list of coil indices in jobs on every plane with its own clean copy of the pipes, in a pool of workers processes if workers > 1.
+        the coils must already be closed and rounded, and a job must hold whole groups from reroute_groups().
+        '''
+        if planes is None:
+            planes = wire_planes(coils,self.pipes)
+        if len(jobs) == 0:
+            return
+        pipes = copy.copy(self)
+        pipes.pipes = [copy.copy(p) for p in self.pipes]
+        pipes.clear_intersects()
+        def subset(part):
+            sub = copy.copy(coils)
+            sub.coils = [coils.coils[i] for i in part]
+            return sub
+        
+        if workers <= 1 or len(jobs) == 1:
+            results = [_reroute_job(pipes,subset(part),pipe_density,planes) for part in jobs]
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                results = list(pool.map(_reroute_job,[pipes]*len(jobs),[subset(part) for part in jobs],
+                                        [pipe_density]*len(jobs),[planes]*len(jobs)))
+        for part, result in zip(jobs,results):
+            for i, (points, rerouted) in zip(part,result):
+                coils.coils[i].points = points
+                coils.coils[i].rerouted = rerouted
+        
+    def reroute_groups(self,coils,planes=None,pipes=False):
+        '''
+        splits the coils into groups that can be re-routed independently of each other.
+        
+        two coils are in the same group if they cross the same pipe in the same plane, checked on the coils as they are before re-routing.
+        returns a list of lists of coil indices, each in increasing order.
+        with pipes=True also returns, for each group, the list of numbers of the pipes in self.pipes that its coils cross.
+        '''
+        if planes is None:
+            planes = wire_planes(coils,self.pipes)
+        parent = np.arange(len(coils.coils))
+        def find(i):
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+        index = segmentindex(coils,level=None)
+        crossed = [] #(pipe number, a coil crossing it)
+        for pl in planes:
+            for k, pipe in enumerate(self.pipes):
+                crossing = np.unique(index.coil_ind[index.candidates(pipe,pl)])
+                for i in crossing[1:]:
+                    parent[find(i)] = find(crossing[0])
+                if len(crossing):
+                    crossed.append((k,crossing[0]))
+        roots = np.array([find(i) for i in range(len(coils.coils))],dtype=int)
+        unique_roots = np.unique(roots)
+        groups = [list(np.flatnonzero(roots == r)) for r in unique_roots]
+        if not pipes:
+            return groups
+        group_pipes = {r:set() for r in unique_roots}
+        for k, i in crossed:
+            group_pipes[roots[i]].add(k)
+        return groups, [sorted(group_pipes[r]) for r in unique_roots]
+        
+    def reroute_wires2(self,coils,pipe_density=14,planes=None):
         '''
         performs the re-routing for all pipes that have flagged intersects from check_intersects that must be run first.
         
         I think that this was the start of a re-write that wasn't completed.
+        the wire planes are found with wire_planes() unless planes is given.
         '''
         #clean up coils to prepare for checking for intersections
         coils.make_closed() #first and last point in last made the same if not already
         coils.round_all() #round some decimal places for easier float comparisons
+        if planes is None:
+            planes = wire_planes(coils,self.pipes)
         
         #pl sets the plane positions to check for re-routes along the plane perpendicular to the axis of each cylindrical pipe.
         #I think this was done to prevent secondary re-routes from occuring on planes that don't contact each other.
@@ -652,16 +1413,18 @@ class pipelist:
                 newpipes[-1].check_intersects(coils, level = 0,plane = pl)
                 
                 temp = pipelist()
+                plan = insertionplan()
                 changes = 0 #track how many lines are changed
                 print("newpipes[-1] = " , newpipes[-1])
                 for index, pipe in enumerate(newpipes[-1].pipes):
                     print("pipelist:reroute_wires: pipe " , index, " of " , len(self.pipes)-1)
                     print("   pipe = " , pipe)
-                    total_reroutes, temppipes = pipe.reroute_wire(pipe_density=pipe_density)
+                    total_reroutes, temppipes = pipe.reroute_wire(pipe_density=pipe_density,plan=plan)
                     changes = changes + total_reroutes
                     print("      Total Reroutes:" , total_reroutes)
                     if temppipes != 0:
                         temp.join_lists(temppipes)
+                plan.apply()
                 newpipes.append(temp)
                 counter = counter+1
                 # go_on = False #uncomment this line to only do the first resets
@@ -752,67 +1515,21 @@ class sparsepipe():
           
           points is the open list assumed to make a closed loop
         '''
-        #for each point pair
-        # print("prints = " , points)
-        # print("roll(points,-1,axis=0) = " , roll(points,-1,axis=0))
-        newpoints = points
-        # print("checking p0 to p1 lines: ")
-        # for p0,p1 in zip(points, roll(points,-1,axis=0)):
-            # print(p0 , " -> " , p1)
-        for p0,p1 in zip(points, np.roll(points,-1,axis=0)):
-            #check if a pipe intersects the line segment
-            # print("p0=" , p0)
-            # print("p1=" , p1)
-            # print("abs(p0[1] - p1[1]) = " , abs(p0[1] - p1[1]))
-            if(abs(p0[1] - p1[1])>0.000001): #if not on a y=constant plane, skip points
-              continue;
-
-            #new points to insert if intersect occurs.
-            x_around=[]
-            y_around=[]
-            z_around=[]
-            # print("p0[0]<hpipe-rpipe = " , p0[0]<self.hpipe-self.rpipe)
-            # print("p1[0]>hpipe+rpipe = " , p1[0]>self.hpipe+self.rpipe)
-            # print("p1[0]<hpipe-rpipe = " , p1[0]<self.hpipe-self.rpipe)
-            # print("p0[0]>hpipe+rpipe = " , p0[0]>self.hpipe+self.rpipe)
-            if(p0[0]<self.hpipe-self.rpipe and p1[0]>self.hpipe+self.rpipe) or (p1[0]<self.hpipe-self.rpipe and p0[0]>self.hpipe+self.rpipe): # end points are outside and on opp0site sides of feed through
-                if(p0[2]<self.vpipe+self.rpipe and p0[2]>self.vpipe-self.rpipe):#if line between top and bottom of feed through
-                    # print('Pipe intersection!')
-                    # print("Intersect points = " , p0 , " and " , p1)
-                    y_around=np.array([p0[1]]*pipe_density)
-                    if(p0[2]>self.vpipe): # go around the top side
-                        theta_start=math.atan2(p0[2]-self.vpipe,sqrt(self.rpipe**2-(p0[2]-self.vpipe)**2))
-                        theta_end=pi-theta_start
-                        theta_around=[theta_start+(theta_end-theta_start)*i/(pipe_density-1) for i in range(0,pipe_density)]
-                        z_around=np.array(self.vpipe+self.rpipe*sin(theta_around))
-                    else: # go around the bottom side
-                        theta_start=math.atan2(self.vpipe-p0[2],sqrt(self.rpipe**2-(p0[2]-self.vpipe)**2))
-                        theta_end=pi-theta_start
-                        theta_around=[theta_start+(theta_end-theta_start)*i/(pipe_density-1) for i in range(0,pipe_density)]
-                        z_around=np.array(self.vpipe-self.rpipe*sin(theta_around))
-                    x_around=np.array(self.hpipe-self.rpipe*cos(theta_around))
-                    #angles above don't care about direction along x-axis, so arrange start point to be closest to p0.
-                    sort_ind = np.argsort(x_around)
-                    # print("sort_ind = \n" , sort_ind)
-                    # print("x_around = \n" , x_around)
-                    # print("y_around = \n" , y_around)
-                    # print("z_around = \n" , z_around)
-                    if p0[0] < p1[0]: #incrementing
-                        x_around=x_around[sort_ind]
-                        y_around=y_around[sort_ind]
-                        z_around=z_around[sort_ind]
-                    else:#p0[0] > p1[0]
-                        x_around=x_around[np.flip(sort_ind)]
-                        y_around=y_around[np.flip(sort_ind)]
-                        z_around=z_around[np.flip(sort_ind)]
-                    ind = np.where((newpoints == p0).all(axis=1))[0][0]
-                    newpoints = np.insert(
-                        newpoints,
-                        ind+1,
-                        np.array([x_around,y_around,z_around]).T,
-                        axis=0)
-                    # print(points)
-        return newpoints
+        #each point pair, including the closing pair from the last point back to the first
+        p0 = np.asarray(points)
+        p1 = np.roll(p0,-1,axis=0)
+        cross = abs(p0[:,1] - p1[:,1]) <= 0.000001 #only lines on a y=constant plane
+        # end points are outside and on opposite sides of feed through
+        cross = cross & (((p0[:,0]<self.hpipe-self.rpipe) & (p1[:,0]>self.hpipe+self.rpipe)) |
+                         ((p1[:,0]<self.hpipe-self.rpipe) & (p0[:,0]>self.hpipe+self.rpipe)))
+        #line between top and bottom of feed through
+        cross = cross & (p0[:,2]<self.vpipe+self.rpipe) & (p0[:,2]>self.vpipe-self.rpipe)
+        ind = np.flatnonzero(cross)
+        if len(ind) == 0:
+            return points
+        #horizontal along x, vertical along z, each arc starting on the side of p0
+        arcs = batch_arcs(np.stack((p0[ind],p1[ind]),axis=1),self.hpipe,self.vpipe,self.rpipe,0,2,pipe_density)
+        return np.insert(p0,np.repeat(ind+1,[len(arc) for arc in arcs]),np.concatenate(arcs),axis=0)
 
     def draw_pipe(self,ax,trans=0.2, div_length = 2, div_rad = 14,**kwargs):
       '''
@@ -1186,43 +1903,145 @@ def QuickDefWallReRouteOvals(mypipes, rad_add=0,color=None):
    
 def OvalCleanUp(all_coil_list):
     #doing some extra clean up to remove points from middle oval faces
+    remove_box_points(all_coil_list,oval_boxes(),keep_size=1)
 
-    #side walls
-    zpipes = [0.93431 , 0.83431, 0.59625, 0.37125, 0.11250, -0.11250, -0.37125, -0.59625, -0.83431, -0.93431]
+def oval_boxes():
+    '''
+    bounding boxes around the middle oval faces cleaned up by OvalCleanUp(), as an (nboxes,3,2) array of (min,max) along x, y and z.
+    '''
+    boxes = []
     ypipes = [0.5850,-0.5850]
-    oval_radius = 20.0/1000.0
-    width = 60.0/1000.0
-    for section in all_coil_list:
-        for z in zpipes:
-            section.remove_points(xmin=-1.5,xmax=1.5, ymin=ypipes[0]-width/2+0.001,ymax=ypipes[0]+width/2-0.001, zmin=z-1.5*oval_radius,zmax=z+1.5*oval_radius, keep_size =1)
-            section.remove_points(xmin=-1.5,xmax=1.5, ymin=ypipes[1]-width/2+0.001,ymax=ypipes[1]+width/2-0.001, zmin=z-1.5*oval_radius,zmax=z+1.5*oval_radius, keep_size =1)
-    #small attachment point ovals
-    zpipes = [0.99681 , 0.77181, 0.65875, 0.30875, 0.1750,-0.175, -0.30875, -0.65875, -0.77181, -0.99681]
-    oval_radius = 5.0/1000.0
-    width = 50.0/1000.0
-    for section in all_coil_list:
+    #side walls, long along x; ovals and then small attachment point ovals
+    for zpipes, oval_radius, width in [([0.93431 , 0.83431, 0.59625, 0.37125, 0.11250, -0.11250, -0.37125, -0.59625, -0.83431, -0.93431],20.0/1000.0,60.0/1000.0),
+                                       ([0.99681 , 0.77181, 0.65875, 0.30875, 0.1750,-0.175, -0.30875, -0.65875, -0.77181, -0.99681],5.0/1000.0,50.0/1000.0)]:
         for z in zpipes:
-            section.remove_points(xmin=-1.5,xmax=1.5, ymin=ypipes[0]-width/2+0.001,ymax=ypipes[0]+width/2-0.001, zmin=z-1.5*oval_radius,zmax=z+1.5*oval_radius, keep_size =1)
-            section.remove_points(xmin=-1.5,xmax=1.5, ymin=ypipes[1]-width/2+0.001,ymax=ypipes[1]+width/2-0.001, zmin=z-1.5*oval_radius,zmax=z+1.5*oval_radius, keep_size =1)
+            for y in ypipes:
+                boxes.append([[-1.5,1.5],[y-width/2+0.001,y+width/2-0.001],[z-1.5*oval_radius,z+1.5*oval_radius]])
+    #floor and ceiling, long along z
+    for xpipes, oval_radius, width in [([0.81110 , 0.71110, 0.45256, 0.39756, -0.39756, -0.45256, -0.71110, -0.81110],20.0/1000.0,60.0/1000.0),
+                                       ([0.87360 , 0.64860, 0.51506, 0.33506, -0.33506, -0.51506, -0.64860, -0.87360],5.0/1000.0,50.0/1000.0)]:
+        for x in xpipes:
+            for y in ypipes:
+                boxes.append([[x-1.5*oval_radius,x+1.5*oval_radius],[y-width/2+0.001,y+width/2-0.001],[-1.5,1.5]])
+    return np.array(boxes)
 
-    #floor and ceiling
-    zpipes = [0.81110 , 0.71110, 0.45256, 0.39756, -0.39756, -0.45256, -0.71110, -0.81110]
-    ypipes = [0.5850,-0.5850]
-    oval_radius = 20.0/1000.0
-    width = 60.0/1000.0
-    for section in all_coil_list:
-        for z in zpipes:
-            section.remove_points(zmin=-1.5,zmax=1.5, ymin=ypipes[0]-width/2+0.001,ymax=ypipes[0]+width/2-0.001, xmin=z-1.5*oval_radius,xmax=z+1.5*oval_radius, keep_size =1)
-            section.remove_points(zmin=-1.5,zmax=1.5, ymin=ypipes[1]-width/2+0.001,ymax=ypipes[1]+width/2-0.001, xmin=z-1.5*oval_radius,xmax=z+1.5*oval_radius, keep_size =1)
-    #small attachment point ovals
-    zpipes = [0.87360 , 0.64860, 0.51506, 0.33506, -0.33506, -0.51506, -0.64860, -0.87360]
-    oval_radius = 5.0/1000.0
-    width = 50.0/1000.0
+def remove_box_points(all_coil_list,boxes,keep_size=1):
+    '''
+    removes the points inside the boxes from every coil of every coilset in all_coil_list, as section.remove_points() for each box in turn and with the same keep_size.
+    
+    boxes is an (nboxes,3,2) array of (min,max) along x, y and z, as from oval_boxes(), in the order the boxes are to be removed.
+    the rules are patchlib's: a point is inside a box when it is strictly between its bounds, and a coil loses the points inside a box only if at least keep_size of its points are left, checked box by box in order on what earlier boxes left.
+    the boxes holding a point of the section are found for all boxes at once by box_hits(), with the bounds included so that none is skipped. For each coil the points to remove are then gathered in one mask over those boxes, and the coil's points are compacted once. When the points left by all of them are at least keep_size, every box in turn would have removed its points, otherwise the boxes are checked one by one.
+    returns the number of points removed.
+    '''
+    boxes = np.asarray(boxes,dtype=float).reshape(-1,3,2)
+    removed = 0
     for section in all_coil_list:
-        for z in zpipes:
-            section.remove_points(zmin=-1.5,zmax=1.5, ymin=ypipes[0]-width/2+0.001,ymax=ypipes[0]+width/2-0.001, xmin=z-1.5*oval_radius,xmax=z+1.5*oval_radius, keep_size =1)
-            section.remove_points(zmin=-1.5,zmax=1.5, ymin=ypipes[1]-width/2+0.001,ymax=ypipes[1]+width/2-0.001, xmin=z-1.5*oval_radius,xmax=z+1.5*oval_radius, keep_size =1)
+        points = [np.asarray(coil.points,dtype=float).reshape(-1,3) for coil in section.coils]
+        if not points:
+            continue
+        hits = boxes[box_hits(np.concatenate(points),boxes)]
+        for coil, p in zip(section.coils, points):
+            if len(p) == 0:
+                continue
+            #only the boxes overlapping the coil's own extent can hold its points
+            near = hits[np.all((hits[:,:,0] < p.max(axis=0)) & (hits[:,:,1] > p.min(axis=0)),axis=1)]
+            inside = np.all((p > near[:,None,:,0]) & (p < near[:,None,:,1]),axis=2)
+            keep = ~inside.any(axis=0)
+            if np.count_nonzero(keep) < keep_size:
+                #some box would leave too few points, so go through them in order as patchlib does
+                keep = np.ones(len(p),dtype=bool)
+                for box_inside in inside:
+                    box_inside = keep & box_inside
+                    if box_inside.any() and np.count_nonzero(keep)-np.count_nonzero(box_inside) >= keep_size:
+                        keep &= ~box_inside
+            if not keep.all():
+                coil.points = np.asarray(coil.points)[keep]
+                removed = removed+len(p)-np.count_nonzero(keep)
+    return removed
+
+def box_hits(points,boxes):
+    '''
+    indices of the boxes holding at least one of the points, bounds included.
+    
+    boxes is an (nboxes,3,2) array of (min,max) along x, y and z. The points are sorted along each axis, each box is looked up along the axis where it spans the fewest points, and only the points found there are checked on the other two axes.
+    '''
+    points = np.asarray(points,dtype=float).reshape(-1,3)
+    order = np.argsort(points,axis=0,kind='stable')
+    values = np.take_along_axis(points,order,axis=0)
+    start = np.array([np.searchsorted(values[:,axis],boxes[:,axis,0],side='left') for axis in range(3)])
+    lengths = np.maximum(np.array([np.searchsorted(values[:,axis],boxes[:,axis,1],side='right') for axis in range(3)])-start,0)
+    axis = np.argmin(lengths,axis=0)
+    box = np.arange(len(boxes))
+    start = start[axis,box]
+    lengths = lengths[axis,box]
+    if lengths.sum() == 0:
+        return np.zeros(0,dtype=int)
+    #the run of sorted points inside each box along its axis, all boxes together
+    box_of = np.repeat(box,lengths)
+    found = order[np.repeat(start,lengths)+np.arange(lengths.sum())-np.repeat(np.cumsum(lengths)-lengths,lengths),np.repeat(axis,lengths)]
+    ok = np.all((points[found] >= boxes[box_of,:,0]) & (points[found] <= boxes[box_of,:,1]),axis=1)
+    return np.flatnonzero(np.bincount(box_of[ok],minlength=len(boxes)))
 
+def compact_points(points,tolerance=1e-7):
+    '''
+    removes the redundant points of a coil loop: repeated points, and points lying on the straight line between their neighbours.
+    
+    the points are an open list closed by the last point joining the first, as for the coils.
+    a point is a candidate if it is within tolerance (m) of the segment joining its two neighbours. A run of candidates is removed only if every point of the run is within tolerance of the segment joining the points kept on either side, so error does not add up along a run.
+    the points of the arcs from re-routing are further than tolerance from their chords and are kept.
+    returns the remaining points in their original order.
+    '''
+    points = np.asarray(points,dtype=float).reshape(-1,3)
+    #zero length segments, including the one closing the loop
+    points = points[np.any(points != np.roll(points,-1,axis=0),axis=1)]
+    n = len(points)
+    if n < 4:
+        return points
+    straight = point_segment_distances(points,np.roll(points,1,axis=0),np.roll(points,-1,axis=0)) <= tolerance
+    if straight.all() or not straight.any():
+        return points
+    #start at a kept point so that no run of candidates wraps around the end of the list
+    shift = np.argmin(straight)
+    looped = np.roll(points,-shift,axis=0)
+    straight = np.roll(straight,-shift)
+    kept = np.flatnonzero(~straight)
+    candidates = np.flatnonzero(straight)
+    after = np.searchsorted(kept,candidates)
+    before = kept[after-1]
+    after = np.append(kept,0)[after]
+    distance = point_segment_distances(looped[candidates],looped[before],looped[after])
+    #largest distance in each run, the runs being the candidates between the same two kept points
+    start = np.flatnonzero(np.diff(before,prepend=-1))
+    runs = np.repeat(np.maximum.reduceat(distance,start),np.diff(np.append(start,len(candidates))))
+    remove = np.zeros(n,dtype=bool)
+    remove[candidates[runs <= tolerance]] = True
+    return points[~np.roll(remove,shift)]
+
+def point_segment_distances(p,a,b):
+    '''
+    distances of the points p from the segments a to b, all (n,3) arrays.
+    '''
+    d = b-a
+    dd = np.sum(d*d,axis=1)
+    t = np.clip(np.sum((p-a)*d,axis=1)/np.where(dd > 0,dd,1),0,1)
+    return np.linalg.norm(p-a-t[:,np.newaxis]*d,axis=1)
+
+def compact_coils(coils,tolerance=1e-7,verbose=True):
+    '''
+    applies compact_points() to every coil of a coilset, so that fewer segments go into the field sums, and prints the reduction if verbose.
+    works with the coilsets read through .coils here and the ones with a .coil list in the scripts.
+    returns the number of segments before and after.
+    '''
+    before = 0
+    after = 0
+    for coil in (coils.coils if hasattr(coils,'coils') else coils.coil):
+        before = before+len(coil.points)
+        coil.points = compact_points(coil.points,tolerance)
+        after = after+len(coil.points)
+    if verbose:
+        print("compact_coils: %i segments reduced to %i (%.1f%% fewer)"%(before,after,100.0*(before-after)/max(before,1)))
+    return before, after
 
 def QuickPipes(pipesC, pipesS, rad_add=0,color=None):
     #Z should be vertical in the model.
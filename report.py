@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+
+'''
+report: headless figure output for the coil and mapping scripts.
+
+The scripts draw their scans and residuals with pyplot and stop at
+every plt.show() until the window is closed.  headless() switches
+matplotlib to the Agg backend and replaces plt.show() by a function
+that saves every open figure into a directory and closes it, so a
+whole script runs through on a node without a display.  Every save
+rewrites index.html in that directory, a page with all the figures
+in the order they were drawn.
+
+write_index() is also used for figures rendered elsewhere, e.g. the
+per-coil gallery of draw_single_coils.py drawn in a process pool.
+
+Usage:
+  if options.report:
+      headless(options.report)   # before importing pyplot
+  import matplotlib.pyplot as plt
+'''
+
+import html
+import os
+import matplotlib
+
+def figure_title(fig):
+    '''
+    the suptitle of a figure, or else the first axes title found
+    '''
+    if fig._suptitle is not None and fig._suptitle.get_text():
+        return fig._suptitle.get_text()
+    for ax in fig.axes:
+        if ax.get_title():
+            return ax.get_title()
+    return ''
+
+def write_index(outdir,images,title='Figures'):
+    '''
+    writes outdir/index.html showing the images, a list of
+    (file name relative to outdir, caption) in order
+    '''
+    rows=['<figure><a href="%s"><img src="%s" width="480"></a><figcaption>%s</figcaption></figure>'
+          %(html.escape(name),html.escape(name),html.escape(caption)) for name,caption in images]
+    page=('<!DOCTYPE html>\n<html><head><meta charset="utf-8"><title>%s</title>\n'
+          '<style>figure{display:inline-block;margin:6px}</style></head>\n'
+          '<body><h1>%s</h1>\n%s\n</body></html>\n')%(html.escape(title),html.escape(title),'\n'.join(rows))
+    with open(os.path.join(outdir,'index.html'),'w') as f:
+        f.write(page)
+
+class figuresaver:
+    '''
+    replacement for plt.show(): saves and closes every open figure
+    '''
+    def __init__(self,outdir,title,dpi):
+        self.outdir=outdir
+        self.title=title
+        self.dpi=dpi
+        self.images=[]
+
+    def __call__(self,*args,**kwargs):
+        import matplotlib.pyplot as plt
+        for num in plt.get_fignums():
+            fig=plt.figure(num)
+            name='%03d_figure%d.png'%(len(self.images),num)
+            fig.savefig(os.path.join(self.outdir,name),dpi=self.dpi,bbox_inches='tight')
+            self.images.append((name,figure_title(fig)))
+            plt.close(fig)
+        write_index(self.outdir,self.images,self.title)
+
+def headless(outdir,title=None,dpi=150):
+    '''
+    switches to the Agg backend and makes plt.show() save the open
+    figures into outdir.  Returns the figuresaver.
+    '''
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    os.makedirs(outdir,exist_ok=True)
+    saver=figuresaver(outdir,title if title is not None else os.path.basename(os.path.abspath(outdir)),dpi)
+    plt.show=saver
+    return saver
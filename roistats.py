@@ -0,0 +1,397 @@
+#!/usr/bin/env python3
+
+'''
+roistats: statistics on the ROI for many regions at once.
+
+Every point of the ROI grid carries a single integer label (e.g. 0 =
+outside the cells, 1 = upper cell, 2 = lower cell).  A region is a
+list of labels, so "Both cells" is just [1,2] and the unmasked ROI is
+every label.
+
+The per-label moments (count, mean, sum of squared deviations, min,
+max) of each quantity are reduced with np.bincount and np.minimum.at /
+np.maximum.at over the flat arrays, and the regions are then built by
+merging the per-label moments.  No boolean-masked copies of the field
+arrays are made, and each quantity is swept once for all regions.
+
+Usage:
+  labels=np.where(z>0,1,2)
+  stats=roistats(labels,{'Upper cell':[1],'Lower cell':[2],'Both cells':[1,2]})
+  res=stats.compute({'bz_target':bz_target,'bz_residual':bz_residual})
+  print(res['Upper cell','bz_residual']['std'])
+'''
+
+import numpy as np
+
+# one record per (region,quantity).  m2 is the sum of squared
+# deviations from the mean, ms is the mean square (used for BT2).
+stats_dtype=np.dtype([('n','i8'),
+                      ('mean','f8'),
+                      ('std','f8'),
+                      ('min','f8'),
+                      ('max','f8'),
+                      ('ms','f8'),
+                      ('m2','f8')])
+
+def label_moments(labels,values,nlabels):
+    '''
+    reduces values onto their labels.  Both arguments are flat arrays
+    of the same length.  Returns (n,mean,m2,min,max), each an array of
+    length nlabels.  Labels with no points have n=0, mean=nan,
+    min=+inf and max=-inf.
+    '''
+    n=np.bincount(labels,minlength=nlabels)
+    total=np.bincount(labels,weights=values,minlength=nlabels)
+    with np.errstate(invalid='ignore',divide='ignore'):
+        mean=total/n
+    # deviations from the per-label mean, so that the variance does
+    # not suffer from cancellation when the mean is large
+    dev=values-mean[labels]
+    m2=np.bincount(labels,weights=dev*dev,minlength=nlabels)
+    vmin=np.full(nlabels,np.inf)
+    np.minimum.at(vmin,labels,values)
+    vmax=np.full(nlabels,-np.inf)
+    np.maximum.at(vmax,labels,values)
+    return n,mean,m2,vmin,vmax
+
+def merge_moments(a,b):
+    '''
+    merges two (n,mean,m2,min,max) tuples of scalars into one, using
+    the pairwise update of Chan, Golub and LeVeque.
+    '''
+    na,meana,m2a,mina,maxa=a
+    nb,meanb,m2b,minb,maxb=b
+    if nb==0:
+        return a
+    if na==0:
+        return b
+    n=na+nb
+    delta=meanb-meana
+    mean=meana+delta*nb/n
+    m2=m2a+m2b+delta*delta*na*nb/n
+    return n,mean,m2,min(mina,minb),max(maxa,maxb)
+
+def moments_to_record(moments,record):
+    '''
+    fills a stats_dtype record from a (n,mean,m2,min,max) tuple
+    '''
+    n,mean,m2,vmin,vmax=moments
+    record['n']=n
+    record['m2']=m2
+    if n>0:
+        record['mean']=mean
+        record['std']=np.sqrt(m2/n) # population std, same as np.std
+        record['ms']=m2/n+mean*mean
+        record['min']=vmin
+        record['max']=vmax
+    else:
+        record['mean']=record['std']=record['ms']=np.nan
+        record['min']=record['max']=np.nan
+
+class roiresult:
+    '''
+    the output of roistats.compute().  table is a structured array of
+    shape (nregions,nquantities) with the fields of stats_dtype.
+    '''
+    def __init__(self,regions,quantities):
+        self.regions=list(regions)
+        self.quantities=list(quantities)
+        self.table=np.zeros((len(self.regions),len(self.quantities)),dtype=stats_dtype)
+
+    def __getitem__(self,key):
+        region,quantity=key
+        return self.table[self.regions.index(region),self.quantities.index(quantity)]
+
+    def bt2(self,region,components):
+        '''
+        average of the squared magnitude over the region, e.g.
+        bt2('Both cells',['bx_residual','by_residual','bz_residual'])
+        '''
+        return sum(self[region,c]['ms'] for c in components)
+
+class roistats:
+    '''
+    statistics of any number of quantities over labelled regions of
+    the ROI.
+
+    labels is an integer array (any shape, e.g. that of the mgrid) of
+    non-negative region labels.  regions maps a name to the list of
+    labels that make it up; regions may overlap.
+    '''
+    def __init__(self,labels,regions):
+        self.shape=np.shape(labels)
+        self.labels=np.ravel(labels).astype(np.intp,copy=False)
+        self.nlabels=int(self.labels.max())+1 if self.labels.size else 1
+        self.regions=dict(regions)
+
+    def label_moments(self,values):
+        # targets that are constant come back from Pislib as scalars
+        values=np.broadcast_to(values,self.shape)
+        return label_moments(self.labels,np.ravel(values),self.nlabels)
+
+    def compute(self,quantities):
+        '''
+        quantities maps a name to an array of the same size as labels.
+        returns a roiresult with every region for every quantity.
+        '''
+        per_label={}
+        for qname,values in quantities.items():
+            per_label[qname]=self.label_moments(values)
+        return regions_result(self.regions,per_label)
+
+def region_moments(per_label,labels):
+    '''
+    merges the per-label moments of the given labels, in sorted label
+    order so that the result does not depend on how the region was
+    written down.
+    '''
+    n,mean,m2,vmin,vmax=per_label
+    moments=(0,np.nan,0.,np.inf,-np.inf)
+    for lab in sorted(labels):
+        if lab<len(n):
+            moments=merge_moments(moments,(n[lab],mean[lab],m2[lab],vmin[lab],vmax[lab]))
+    return moments
+
+def regions_result(regions,per_label):
+    '''
+    builds a roiresult from per-label moments.  per_label maps each
+    quantity name to the (n,mean,m2,min,max) arrays of label_moments.
+    '''
+    res=roiresult(regions.keys(),per_label.keys())
+    for j,moments in enumerate(per_label.values()):
+        for i,labs in enumerate(regions.values()):
+            moments_to_record(region_moments(moments,labs),res.table[i,j])
+    return res
+
+def merge_label_moments(a,b):
+    '''
+    merge_moments() for the per-label arrays of label_moments(), all
+    labels at once.
+    '''
+    na,meana,m2a,mina,maxa=a
+    nb,meanb,m2b,minb,maxb=b
+    n=na+nb
+    with np.errstate(invalid='ignore',divide='ignore'):
+        delta=meanb-meana
+        mean=np.where(na==0,meanb,np.where(nb==0,meana,meana+delta*nb/n))
+        m2=np.where((na==0)|(nb==0),m2a+m2b,m2a+m2b+delta*delta*na*nb/n)
+    return n,mean,m2,np.minimum(mina,minb),np.maximum(maxa,maxb)
+
+class roiaccumulator:
+    '''
+    streaming version of roistats.compute(), for ROI grids too big to
+    hold in memory.  Tiles of the grid are fed in with add() as they
+    are evaluated, each with an integer tile number 0,1,2,...
+
+    The per-label moments of the tiles are combined on a fixed binary
+    tree over the tile numbers (tiles 2k and 2k+1 make node k of the
+    next level up, and so on), so the result is bit-for-bit the same
+    whatever order the tiles arrive in, and whichever worker processed
+    them.  Accumulators filled by different processes over disjoint
+    tiles are combined with merge().  Tiles that arrive in order keep
+    only O(log ntiles) nodes alive.
+
+    Usage:
+      acc=roiaccumulator(cell_regions)
+      for tile,(x,y,z) in enumerate(grid_slabs(xs,ys,zs,10)):
+          acc.add(tile,cell_labels(x,y,z),{'bz_target':bztarget(x,y,z)})
+      res=acc.result()
+    '''
+    def __init__(self,regions,nlabels=None):
+        self.regions=dict(regions)
+        if nlabels is None:
+            nlabels=max(max(labs) for labs in self.regions.values())+1
+        self.nlabels=nlabels
+        self.nodes={} # (level,index) -> {quantity:(n,mean,m2,min,max)}
+
+    def add(self,tile,labels,quantities):
+        shape=np.shape(labels)
+        labels=np.ravel(labels).astype(np.intp,copy=False)
+        node={}
+        for qname,values in quantities.items():
+            values=np.ravel(np.broadcast_to(values,shape))
+            node[qname]=label_moments(labels,values,self.nlabels)
+        self.insert(0,tile,node)
+
+    def insert(self,level,index,node):
+        # climb the tree for as long as the sibling is already here
+        while (level,index^1) in self.nodes:
+            sibling=self.nodes.pop((level,index^1))
+            if index%2==0:
+                node=self.combine(node,sibling)
+            else:
+                node=self.combine(sibling,node)
+            level=level+1
+            index=index//2
+        if (level,index) in self.nodes:
+            raise ValueError('tile added twice (level %d, index %d)'%(level,index))
+        self.nodes[(level,index)]=node
+
+    def combine(self,left,right):
+        return {q:merge_label_moments(left[q],right[q]) for q in left}
+
+    def merge(self,other):
+        '''
+        adds the tiles of another accumulator over disjoint tiles
+        '''
+        for (level,index),node in sorted(other.nodes.items()):
+            self.insert(level,index,node)
+
+    def result(self):
+        '''
+        returns a roiresult, as from roistats.compute().  The leftover
+        subtrees are combined from the first tile to the last.
+        '''
+        if not self.nodes:
+            raise ValueError('no tiles have been added')
+        keys=sorted(self.nodes,key=lambda k:k[1]<<k[0])
+        node=self.nodes[keys[0]]
+        for key in keys[1:]:
+            node=self.combine(node,self.nodes[key])
+        return regions_result(self.regions,node)
+
+def grid_slabs(xs,ys,zs,nslabs):
+    '''
+    yields the mgrid of the axes xs, ys, zs in nslabs slabs along x,
+    each as an (x,y,z) tuple of 3D arrays, for use with roiaccumulator
+    '''
+    for xslab in np.array_split(np.asarray(xs),nslabs):
+        if len(xslab)>0:
+            yield np.meshgrid(xslab,ys,zs,indexing='ij')
+
+def cell_labels(x,y,z,incells=False,rcell=0.3,hcell=0.1601,dcell=0.08):
+    '''
+    labels for the ROI statistics of the squares scripts:
+      0 outside the ROI, 1 upper cell (z>0), 2 lower cell (z<0),
+      3 in the ROI on the z=0 plane.
+    with incells the ROI is the two EDM cells, otherwise the whole grid.
+    '''
+    if(incells):
+        inroi=(abs(z)>=dcell/2)&(abs(z)<=dcell/2+hcell)&(x**2+y**2<rcell**2)
+    else:
+        inroi=np.full(np.shape(z),True)
+    labels=np.where(z>0,1,np.where(z<0,2,3))
+    return np.where(inroi,labels,0)
+
+def grid_stats(values):
+    '''
+    stats_dtype record of every point of an array, no labels needed
+    '''
+    values=np.asarray(values)
+    return roistats(np.zeros(np.shape(values),dtype=np.intp),{'All':[0]}).compute({'v':values})['All','v']
+
+class edmcells:
+    '''
+    the two EDM cells: cylinders of radius rcell and height hcell,
+    with their inner faces dcell apart and centred on the origin.
+
+    For an mgrid built from the 1D axes xs, ys, zs, index() returns
+    the flat indices of the grid points inside the upper and lower
+    cells.  The cylinder test is separable (a disk in x,y times a band
+    in z), so the indices are built from a 2D and a 1D test rather
+    than evaluating the condition over the full 3D grid, and they are
+    kept for reuse for as long as the object lives.  points() returns
+    just those points, so that fields need only be evaluated in the
+    cells.
+    '''
+    def __init__(self,rcell=0.3,hcell=0.1601,dcell=0.08):
+        self.rcell=rcell # m, cell radius
+        self.hcell=hcell # m, cell height
+        self.dcell=dcell # m, bottom to top distance of cells
+        self.cache={}
+
+    def index(self,xs,ys,zs):
+        xs=np.asarray(xs)
+        ys=np.asarray(ys)
+        zs=np.asarray(zs)
+        key=(xs.tobytes(),ys.tobytes(),zs.tobytes())
+        if key not in self.cache:
+            xx,yy=np.meshgrid(xs,ys,indexing='ij')
+            ixy=np.flatnonzero(xx**2+yy**2<self.rcell**2) # i*ny+j
+            inz=(abs(zs)>=self.dcell/2)&(abs(zs)<=self.dcell/2+self.hcell)
+            iz_upper=np.flatnonzero(inz&(zs>0))
+            iz_lower=np.flatnonzero(inz&(zs<0))
+            nz=len(zs)
+            upper=(ixy[:,None]*nz+iz_upper[None,:]).ravel()
+            lower=(ixy[:,None]*nz+iz_lower[None,:]).ravel()
+            self.cache[key]=(upper,lower)
+        return self.cache[key]
+
+    def points(self,xs,ys,zs):
+        '''
+        returns x,y,z,labels of the grid points in the cells, with
+        labels as in cell_labels (1 upper cell, 2 lower cell)
+        '''
+        upper,lower=self.index(xs,ys,zs)
+        idx=np.concatenate((upper,lower))
+        labels=np.concatenate((np.full(len(upper),1,dtype=np.intp),
+                               np.full(len(lower),2,dtype=np.intp)))
+        ny=len(ys)
+        nz=len(zs)
+        return (np.asarray(xs)[idx//(ny*nz)],
+                np.asarray(ys)[(idx//nz)%ny],
+                np.asarray(zs)[idx%nz],
+                labels)
+
+    def fraction(self,xs,ys,zs):
+        '''
+        fraction of the grid points that are in the cells
+        '''
+        upper,lower=self.index(xs,ys,zs)
+        return (len(upper)+len(lower))/(len(xs)*len(ys)*len(zs))
+
+# the regions reported by the squares scripts
+cell_regions={'All':[0,1,2,3],
+              'Both cells':[1,2,3],
+              'Upper cell':[1],
+              'Lower cell':[2]}
+
+def print_roi_report(res,unmasked=None):
+    '''
+    prints the "Statistics on the ROI" report of the squares scripts
+    from a roiresult computed over cell_regions with the quantities
+    b[xyz]_target and b[xyz]_residual.  Returns bz_delta, the unmasked
+    max-min of the target Bz used to normalize to 3 nT.
+
+    unmasked is the stats_dtype record of the target Bz over the full
+    grid; if not given it is taken from the 'All' region of res.
+    '''
+    print('Statistics on the ROI')
+
+    if unmasked is None:
+        bz_all=res['All','bz_target']
+    else:
+        bz_all=unmasked
+    bz_ave=bz_all['mean']
+    print('The unmasked average Bz prior to correction is %e'%bz_ave)
+    bz_max=bz_all['max']
+    bz_min=bz_all['min']
+    bz_delta=bz_max-bz_min
+    print('The unmasked max/min/diff Bz are %e %e %e'%(bz_max,bz_min,bz_delta))
+    print('We normalize this to 3 nT max-min')
+
+    for region in ['Both cells','Upper cell','Lower cell']:
+        print(region)
+        target=res[region,'bz_target']
+        bz_mask_delta=target['max']-target['min']
+        print('The max/min/diff Bz masks are %e %e %e'%(target['max'],target['min'],bz_mask_delta))
+        print('Normalizing to 3 nT gives a delta of %f nT'%(bz_mask_delta/bz_delta*3))
+        print('The masked standard deviation of Bz is %e'%target['std'])
+        print('Normalizing to 3 nT gives a standard deviation of %f nT'%(target['std']/bz_delta*3))
+
+        residual=res[region,'bz_residual']
+        bz_residual_delta=residual['max']-residual['min']
+        print('The max/min/diff Bz residuals are %e %e %e'%(residual['max'],residual['min'],bz_residual_delta))
+        print('Normalizing to 3 nT gives a delta of %f nT'%(bz_residual_delta/bz_delta*3))
+        print('The standard deviation of Bz residuals is %e'%residual['std'])
+        print('Normalizing to 3 nT gives a standard deviation of %f nT'%(residual['std']/bz_delta*3))
+
+    bt2_ave=res.bt2('Both cells',['bx_target','by_target','bz_target'])
+    print('The BT2 prior to correction is %e'%bt2_ave)
+    print('Normalized is %f nT^2'%(bt2_ave*3**2/bz_delta**2))
+
+    bt2_residual_ave=res.bt2('Both cells',['bx_residual','by_residual','bz_residual'])
+    print('The BT2 after correction is %e'%bt2_residual_ave)
+    print('Normalized is %f nT^2'%(bt2_residual_ave*3**2/bz_delta**2))
+
+    return bz_delta
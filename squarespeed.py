@@ -18,6 +18,8 @@ import numpy as np
 from patchlib.patch import *
 from Pis.Pislib import *
 from dipole import *
+from roistats import *
+from tolerance import *
 
 from optparse import OptionParser
 
@@ -62,6 +64,10 @@ parser.add_option("-a", "--axes", dest="axes", default=False,
 parser.add_option("-i", "--incells", dest="incells", default=False,
                   action="store_true",
                   help="ROI for statistics is in EDM cells")
+parser.add_option("-T", "--tiles", dest="tiles", default=0, type="int",
+                  help="number of slabs to stream the ROI statistics through; 0 holds the full grid")
+parser.add_option("--ranking", dest="ranking", default=None,
+                  help="write the per-coil placement sensitivity table to this file")
 
 d=dipole(1.2,0,0,0,0,1)  # dipole1
 #d=dipole(0,0,1.2,0,0,1)  # dipole2
@@ -606,130 +612,81 @@ plt.show()
 # studies over an ROI
 #x,y,z=np.mgrid[-.25:.25:51j,-.25:.25:51j,-.25:.25:51j]
 #x,y,z=np.mgrid[-.49:.49:99j,-.49:.49:99j,-.49:.49:99j]
-x,y,z=np.mgrid[-.49:.49:100j,-.49:.49:100j,-.49:.49:100j]
-
-if(options.incells):
-    rcell=0.3 # m, cell radius
-    hcell=0.1601 # m, cell height
-    dcell=0.08 # m, bottom to top distance of cells
-    mask=(abs(z)>=dcell/2)&(abs(z)<=dcell/2+hcell)&(x**2+y**2<rcell**2)
-    mask_upper=(abs(z)>=dcell/2)&(abs(z)<=dcell/2+hcell)&(x**2+y**2<rcell**2)&(z>0)
-    mask_lower=(abs(z)>=dcell/2)&(abs(z)<=dcell/2+hcell)&(x**2+y**2<rcell**2)&(z<0)
+# the grid axes; the full grid is only made when it is held whole
+xs=ys=zs=np.linspace(-.49,.49,100)
+
+if(options.tiles>0):
+    # stream the grid through in slabs, only one slab's fields are held
+    acc=roiaccumulator(cell_regions)
+    for tile,(xt,yt,zt) in enumerate(grid_slabs(xs,ys,zs,options.tiles)):
+        labels_t=cell_labels(xt,yt,zt,incells=options.incells)
+        bxt,byt,bzt=mycube.b_prime(xt,yt,zt)
+        bxt_target=bxtarget(xt,yt,zt)
+        byt_target=bytarget(xt,yt,zt)
+        bzt_target=bztarget(xt,yt,zt)
+        acc.add(tile,labels_t,{'bx_target':bxt_target,'by_target':byt_target,'bz_target':bzt_target,
+                               'bx_residual':bxt-bxt_target,'by_residual':byt-byt_target,'bz_residual':bzt-bzt_target})
+    bz_delta=print_roi_report(acc.result())
+    print
 else:
-    mask=np.full(np.shape(z),True)
-    mask_upper=(z>0)
-    mask_lower=(z<0)
-
-# This is used to test the cell dimensions.
-
-#fig=plt.figure()
-#ax=fig.add_subplot(111,projection='3d')
-#scat=ax.scatter(x[mask_upper],y[mask_upper],z[mask_upper])
-#plt.show()
-
-bx_roi,by_roi,bz_roi=mycube.b_prime(x,y,z)
-bx_target=bxtarget(x,y,z)
-by_target=bytarget(x,y,z)
-bz_target=bztarget(x,y,z)
-bx_residual=bx_roi-bx_target
-by_residual=by_roi-by_target
-bz_residual=bz_roi-bz_target
-
-print(np.shape(bx_roi))
-
-print('Statistics on the ROI')
-print
-
-
-
-bz_ave=np.average(bz_target)
-print('The unmasked average Bz prior to correction is %e'%bz_ave)
-bz_max=np.amax(bz_target)
-bz_min=np.amin(bz_target)
-bz_delta=bz_max-bz_min
-print('The unmasked max/min/diff Bz are %e %e %e'%(bz_max,bz_min,bz_delta))
-print('We normalize this to 3 nT max-min')
-print
-
-print('Both cells')
-bz_mask_max=np.amax(bz_target[mask])
-bz_mask_min=np.amin(bz_target[mask])
-bz_mask_delta=bz_mask_max-bz_mask_min
-print('The max/min/diff Bz masks are %e %e %e'%(bz_mask_max,bz_mask_min,bz_mask_delta))
-print('Normalizing to 3 nT gives a delta of %f nT'%(bz_mask_delta/bz_delta*3))
-bz_std=np.std(bz_target[mask])
-print('The masked standard deviation of Bz is %e'%bz_std)
-print('Normalizing to 3 nT gives a standard deviation of %f nT'%(bz_std/bz_delta*3))
-print
-
-bz_residual_max=np.amax(bz_residual[mask])
-bz_residual_min=np.amin(bz_residual[mask])
-bz_residual_delta=bz_residual_max-bz_residual_min
-print('The max/min/diff Bz residuals are %e %e %e'%(bz_residual_max,bz_residual_min,bz_residual_delta))
-print('Normalizing to 3 nT gives a delta of %f nT'%(bz_residual_delta/bz_delta*3))
-bz_residual_std=np.std(bz_residual[mask])
-print('The standard deviation of Bz residuals is %e'%bz_residual_std)
-print('Normalizing to 3 nT gives a standard deviation of %f nT'%(bz_residual_std/bz_delta*3))
-print
-
-print('Upper cell')
-bz_mask_max=np.amax(bz_target[mask_upper])
-bz_mask_min=np.amin(bz_target[mask_upper])
-bz_mask_delta=bz_mask_max-bz_mask_min
-print('The max/min/diff Bz masks are %e %e %e'%(bz_mask_max,bz_mask_min,bz_mask_delta))
-print('Normalizing to 3 nT gives a delta of %f nT'%(bz_mask_delta/bz_delta*3))
-bz_std=np.std(bz_target[mask_upper])
-print('The masked standard deviation of Bz is %e'%bz_std)
-print('Normalizing to 3 nT gives a standard deviation of %f nT'%(bz_std/bz_delta*3))
-print
-
-bz_residual_max=np.amax(bz_residual[mask_upper])
-bz_residual_min=np.amin(bz_residual[mask_upper])
-bz_residual_delta=bz_residual_max-bz_residual_min
-print('The max/min/diff Bz residuals are %e %e %e'%(bz_residual_max,bz_residual_min,bz_residual_delta))
-print('Normalizing to 3 nT gives a delta of %f nT'%(bz_residual_delta/bz_delta*3))
-bz_residual_std=np.std(bz_residual[mask_upper])
-print('The standard deviation of Bz residuals is %e'%bz_residual_std)
-print('Normalizing to 3 nT gives a standard deviation of %f nT'%(bz_residual_std/bz_delta*3))
-print
-
-print('Lower cell')
-bz_mask_max=np.amax(bz_target[mask_lower])
-bz_mask_min=np.amin(bz_target[mask_lower])
-bz_mask_delta=bz_mask_max-bz_mask_min
-print('The max/min/diff Bz masks are %e %e %e'%(bz_mask_max,bz_mask_min,bz_mask_delta))
-print('Normalizing to 3 nT gives a delta of %f nT'%(bz_mask_delta/bz_delta*3))
-bz_std=np.std(bz_target[mask_lower])
-print('The masked standard deviation of Bz is %e'%bz_std)
-print('Normalizing to 3 nT gives a standard deviation of %f nT'%(bz_std/bz_delta*3))
-print
-
-bz_residual_max=np.amax(bz_residual[mask_lower])
-bz_residual_min=np.amin(bz_residual[mask_lower])
-bz_residual_delta=bz_residual_max-bz_residual_min
-print('The max/min/diff Bz residuals are %e %e %e'%(bz_residual_max,bz_residual_min,bz_residual_delta))
-print('Normalizing to 3 nT gives a delta of %f nT'%(bz_residual_delta/bz_delta*3))
-bz_residual_std=np.std(bz_residual[mask_lower])
-print('The standard deviation of Bz residuals is %e'%bz_residual_std)
-print('Normalizing to 3 nT gives a standard deviation of %f nT'%(bz_residual_std/bz_delta*3))
-print
-
-
-bt2_target=bx_target**2+by_target**2+bz_target**2
-bt2_ave=np.average(bt2_target[mask])
-print('The BT2 prior to correction is %e'%bt2_ave)
-bt2_ave_norm=bt2_ave*3**2/bz_delta**2
-print('Normalized is %f nT^2'%(bt2_ave_norm))
-
-bt2_residual=bx_residual**2+by_residual**2+bz_residual**2
-bt2_residual_ave=np.average(bt2_residual[mask])
-print('The BT2 after correction is %e'%bt2_residual_ave)
-bt2_residual_ave_norm=bt2_residual_ave*3**2/bz_delta**2
-print('Normalized is %f nT^2'%(bt2_residual_ave_norm))
-print
+    x,y,z=np.meshgrid(xs,ys,zs,indexing='ij')
+    if(options.incells):
+        rcell=0.3 # m, cell radius
+        hcell=0.1601 # m, cell height
+        dcell=0.08 # m, bottom to top distance of cells
+        # only the grid points in the cells are evaluated
+        cells=edmcells(rcell,hcell,dcell)
+        xroi,yroi,zroi,labels=cells.points(xs,ys,zs)
+        print('Evaluating the ROI at %d of %d grid points'%(np.size(labels),np.size(z)))
+    else:
+        xroi,yroi,zroi=x,y,z
+        labels=cell_labels(x,y,z)
+
+    # This is used to test the cell dimensions.
+
+    #fig=plt.figure()
+    #ax=fig.add_subplot(111,projection='3d')
+    #scat=ax.scatter(xroi[labels==1],yroi[labels==1],zroi[labels==1])
+    #plt.show()
+
+    bx_roi,by_roi,bz_roi=mycube.b_prime(xroi,yroi,zroi)
+    bx_target=bxtarget(xroi,yroi,zroi)
+    by_target=bytarget(xroi,yroi,zroi)
+    bz_target=bztarget(xroi,yroi,zroi)
+    bx_residual=bx_roi-bx_target
+    by_residual=by_roi-by_target
+    bz_residual=bz_roi-bz_target
+
+    print(np.shape(bx_roi))
+
+    # all regions and all components in one sweep, no masked copies
+    roi=roistats(labels,cell_regions)
+    res=roi.compute({'bx_target':bx_target,'by_target':by_target,'bz_target':bz_target,
+                     'bx_residual':bx_residual,'by_residual':by_residual,'bz_residual':bz_residual})
+    if(options.incells):
+        # the 3 nT normalization is always to the target over the full grid
+        bz_delta=print_roi_report(res,unmasked=grid_stats(bztarget(x,y,z)))
+    else:
+        bz_delta=print_roi_report(res)
+    print
 
 print('The normalized currents are:')
 vec_i=vec_i*3e-9/bz_delta
 print(vec_i)
 print('The maximum current is %f A'%np.amax(vec_i))
 print('The minimum current is %f A'%np.amin(vec_i))
+
+if(options.ranking):
+    # which coils dominate the uniformity budget when misplaced, on a
+    # coarse version of the ROI the statistics above are taken over
+    if(options.incells):
+        xr=yr=zr=np.linspace(xs[0],xs[-1],21)
+        xt,yt,zt,labels_t=edmcells().points(xr,yr,zr)
+    else:
+        xr=yr=zr=np.linspace(xs[0],xs[-1],11)
+        xt,yt,zt=np.meshgrid(xr,yr,zr,indexing='ij')
+    ranking=coil_placement_sensitivity(coilgeometry.from_coilset(mycube),
+                                       np.stack((xt,yt,zt),axis=-1).reshape(-1,3),vec_i)
+    print_ranking(ranking)
+    print_ranking(ranking,order='rank_deg')
+    write_ranking(ranking,options.ranking)
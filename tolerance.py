@@ -0,0 +1,550 @@
+#!/usr/bin/env python3
+
+'''
+tolerance: Monte Carlo coil-placement tolerance studies.
+
+myset.wiggle() applies one random perturbation to the coil set, which
+is only good for looking at traces.  Here the coil vertices are pulled
+out of the coilset once, and N perturbed copies of them are drawn with
+a seeded generator and evaluated in vectorized batches with a
+straight-segment Biot-Savart law.  For each trial we keep
+
+  - the residual (field-target) std over the ROI with the nominal
+    currents, i.e. what the as-built coils give if we do not recalibrate,
+  - the residual std over the ROI with currents refit to the sensors for
+    the perturbed geometry, and
+  - the refit currents themselves,
+
+and report percentiles of them over all trials.  coil_placement_sensitivity()
+ranks the coils by the ROI field error their misplacement induces.
+
+For small errors the trials are done as a first-order update from the
+analytic derivative of every coil's field with respect to each vertex
+coordinate (coilgeometry.sensitivity), which turns each trial into a
+matrix product; larger moves are recomputed exactly.
+
+fieldcache keeps the per-coil fields at fixed points and updates them
+from just the segments a re-route (pipesfitting.py) changed.
+
+Usage:
+  geom=coilgeometry.from_coilset(myset)
+  study=tolerancestudy(geom,sensors,target,roi,roi_target,currents=vec_i)
+  res=study.run(10000,0.001,seed=1,batch=64)
+  res.print_report()
+'''
+
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+
+mu0_over_4pi=1e-7 # T m/A
+
+# largest number of (segment,point) vectors in one temporary array when
+# the segment fields are summed block by block, about 25 MB each
+block_vectors=2**20
+
+def segment_blocks(nseg,npts):
+    '''
+    slices of the nseg segments in blocks of at most
+    block_vectors//npts segments (at least one), so that the per-segment
+    arrays of a block at npts points stay small however many segments
+    and points there are.  npts counts any batch dimensions too.
+    '''
+    step=max(1,block_vectors//max(1,npts))
+    return [slice(lo,min(lo+step,nseg)) for lo in range(0,nseg,step)]
+
+def summed_segment_fields(starts,ends,r,weights=None):
+    '''
+    sum over the (nseg,3) segments starts->ends of segment_fields() at
+    the points r, each times its weight if given, evaluated in
+    segment_blocks().  Returns (npts,3).
+    '''
+    total=np.zeros((len(r),3))
+    for block in segment_blocks(len(starts),len(r)):
+        per_seg=segment_fields(starts[block],ends[block],r)
+        if weights is None:
+            total+=np.sum(per_seg,axis=0)
+        else:
+            total+=np.tensordot(weights[block],per_seg,axes=(0,0))
+    return total
+
+def segment_fields(starts,ends,r):
+    '''
+    field per ampere of the straight segments starts->ends at the
+    points r.  starts and ends are (...,nseg,3), r is (npts,3).
+    Returns (...,nseg,npts,3).  Points on a segment get zero field.
+    '''
+    a=starts[...,:,np.newaxis,:]-r # (...,nseg,npts,3)
+    b=ends[...,:,np.newaxis,:]-r
+    la=np.sqrt(np.sum(a*a,axis=-1))
+    lb=np.sqrt(np.sum(b*b,axis=-1))
+    denom=la*lb*(la*lb+np.sum(a*b,axis=-1))
+    with np.errstate(invalid='ignore',divide='ignore'):
+        factor=np.where(denom>1e-30,mu0_over_4pi*(la+lb)/denom,0.)
+    return np.cross(a,b)*factor[...,np.newaxis]
+
+def segment_sensitivities(starts,ends,r):
+    '''
+    derivatives of segment_fields() with respect to the segment ends.
+    starts and ends are (nseg,3), r is (npts,3).  Returns (dstart,dend),
+    each (nseg,3,npts,3): [s,j,p,k] is dB_k at point p per unit move of
+    coordinate j of the start (end) of segment s, per ampere.
+    '''
+    a=starts[:,np.newaxis,:]-r # (nseg,npts,3)
+    b=ends[:,np.newaxis,:]-r
+    la=np.sqrt(np.sum(a*a,axis=-1))
+    lb=np.sqrt(np.sum(b*b,axis=-1))
+    c=np.sum(a*b,axis=-1)
+    d=la*lb*(la*lb+c)
+    ok=d>1e-30
+    d=np.where(ok,d,1.)
+    la=np.where(ok,la,1.)
+    lb=np.where(ok,lb,1.)
+    f=(la+lb)/d
+    # f=(la+lb)/d with d=la*lb*(la*lb+c)
+    df_dla=1./d-(la+lb)/d**2*lb*(2*la*lb+c)
+    df_dlb=1./d-(la+lb)/d**2*la*(2*la*lb+c)
+    df_dc=-(la+lb)/d**2*la*lb
+    axb=np.cross(a,b)
+    eye=np.eye(3)
+    dstart=np.empty(np.shape(starts)[:1]+(3,)+np.shape(a)[1:])
+    dend=np.empty_like(dstart)
+    for j in range(3):
+        dfa=df_dla*a[...,j]/la+df_dc*b[...,j]
+        dfb=df_dlb*b[...,j]/lb+df_dc*a[...,j]
+        dstart[:,j]=np.cross(eye[j],b)*f[...,np.newaxis]+axb*dfa[...,np.newaxis]
+        dend[:,j]=np.cross(a,eye[j])*f[...,np.newaxis]+axb*dfb[...,np.newaxis]
+    scale=mu0_over_4pi*ok[:,np.newaxis,:,np.newaxis]
+    return dstart*scale,dend*scale
+
+def segment_distances(starts,ends,r):
+    '''
+    (nseg,npts) distances from the points r to the segments
+    '''
+    d=ends-starts
+    a=r[np.newaxis,:,:]-starts[:,np.newaxis,:]
+    dd=np.sum(d*d,axis=-1)[:,np.newaxis]
+    with np.errstate(invalid='ignore',divide='ignore'):
+        t=np.clip(np.where(dd>0,np.sum(a*d[:,np.newaxis,:],axis=-1)/dd,0.),0.,1.)
+    return np.sqrt(np.sum((a-t[...,np.newaxis]*d[:,np.newaxis,:])**2,axis=-1))
+
+def coilset_points(myset):
+    '''
+    the points of each coil of a coilset, as a list of arrays
+    '''
+    # coilcube in squarespeed.py has a coil(i) method instead of a list,
+    # and the coilsets re-routed in pipesfitting.py are read through .coils
+    if hasattr(myset,'coils'):
+        return [c.points for c in myset.coils]
+    if callable(myset.coil):
+        return [myset.coil(i).points for i in range(myset.numcoils)]
+    return [myset.coil[i].points for i in range(myset.numcoils)]
+
+def loop_segments(points):
+    '''
+    the closed-loop segments of an open point list as an (n,6) array of
+    start and end points, the last point joining the first
+    '''
+    points=np.reshape(np.asarray(points,dtype=float),(-1,3))
+    return np.concatenate((points,np.roll(points,-1,axis=0)),axis=1)
+
+def segment_changes(before,after):
+    '''
+    the segments by which the loop through the points after differs
+    from the loop through before, as (starts,ends,weights) with weight
+    +1 for a segment that was added and -1 for one that was removed.
+    Segments are matched exactly, so the straight pieces a re-route
+    leaves alone cancel and only the replaced pieces and the inserted
+    arcs are left.  Zero-length segments are dropped.
+    '''
+    seg_after=loop_segments(after)
+    seg_before=loop_segments(before)
+    segs=np.concatenate((seg_after,seg_before))
+    weights=np.concatenate((np.ones(len(seg_after)),-np.ones(len(seg_before))))
+    keep=np.any(segs[:,:3]!=segs[:,3:],axis=1)
+    segs=np.ascontiguousarray(segs[keep])
+    weights=weights[keep]
+    row=np.dtype((np.void,segs.dtype.itemsize*6))
+    unique,inverse=np.unique(segs.view(row).ravel(),return_inverse=True)
+    net=np.bincount(np.ravel(inverse),weights=weights,minlength=len(unique))
+    changed=np.flatnonzero(net!=0)
+    segs=unique[changed].view(float).reshape(-1,6)
+    return segs[:,:3],segs[:,3:],net[changed]
+
+class fieldcache:
+    '''
+    the field per ampere of each coil at fixed points r, kept up to
+    date as the coils are re-routed.  update() only evaluates the
+    segments that changed (segment_changes) and adds their field to
+    the cached response, instead of rebuilding every coil.
+
+    Build it from the coils as they go into the re-routing (after
+    round_all(), since rounding moves every point), e.g.
+      cache=fieldcache.from_coilset(coils,r)
+      mypipes.reroute_wires(coils)
+      changed=cache.update_from_coilset(coils)
+      cache.fields # (ncoils,npts,3)
+    '''
+    def __init__(self,pointsets,r):
+        self.r=np.reshape(np.asarray(r,dtype=float),(-1,3))
+        self.points=[np.reshape(np.asarray(p,dtype=float),(-1,3)) for p in pointsets]
+        self.fields=np.array([self.loop_fields(p) for p in self.points]).reshape(len(self.points),len(self.r),3)
+        self.segments_evaluated=0 # by update(), against
+        self.segments_full=0      # for recomputing the changed coils
+
+    @classmethod
+    def from_coilset(cls,myset,r):
+        return cls(coilset_points(myset),r)
+
+    def loop_fields(self,points):
+        if len(points)==0:
+            return np.zeros((len(self.r),3))
+        segs=loop_segments(points)
+        return summed_segment_fields(segs[:,:3],segs[:,3:],self.r)
+
+    def update(self,pointsets):
+        '''
+        brings the cached fields up to the coils with the given points
+        and returns the indices of the coils that changed
+        '''
+        changed=[]
+        for i,points in enumerate(pointsets):
+            points=np.reshape(np.asarray(points,dtype=float),(-1,3))
+            if np.array_equal(points,self.points[i]):
+                continue
+            starts,ends,weights=segment_changes(self.points[i],points)
+            if len(weights)>0:
+                self.fields[i]+=summed_segment_fields(starts,ends,self.r,weights)
+            self.points[i]=points
+            self.segments_evaluated+=len(weights)
+            self.segments_full+=len(points)
+            changed.append(i)
+        return np.array(changed,dtype=int)
+
+    def update_from_coilset(self,myset):
+        return self.update(coilset_points(myset))
+
+    def print_report(self):
+        print('fieldcache: %d segments evaluated for the changed coils, %d to recompute them'%(
+            self.segments_evaluated,self.segments_full))
+
+class coilgeometry:
+    '''
+    the vertices of every coil of a coilset in one flat (nverts,3)
+    array, with the closed-loop segments of each coil given as pairs
+    of vertex indices.  Perturbed geometries are just other vertex
+    arrays of the same shape (or a stack of them).
+    '''
+    def __init__(self,pointsets):
+        pointsets=[np.asarray(p,dtype=float) for p in pointsets]
+        self.ncoils=len(pointsets)
+        self.nverts_per_coil=np.array([len(p) for p in pointsets])
+        self.offsets=np.concatenate(([0],np.cumsum(self.nverts_per_coil)))
+        self.verts=np.concatenate(pointsets)
+        # the coil points are an open list; the last vertex joins the first
+        self.seg_start=np.arange(len(self.verts))
+        self.seg_end=np.concatenate([np.roll(np.arange(self.offsets[i],self.offsets[i+1]),-1)
+                                     for i in range(self.ncoils)])
+        self.coil_of_vert=np.repeat(np.arange(self.ncoils),self.nverts_per_coil)
+
+    @classmethod
+    def from_coilset(cls,myset):
+        return cls(coilset_points(myset))
+
+    def centroids(self):
+        return np.add.reduceat(self.verts,self.offsets[:-1],axis=0)/self.nverts_per_coil[:,np.newaxis]
+
+    def coil_points(self,i,verts=None):
+        if verts is None:
+            verts=self.verts
+        return verts[...,self.offsets[i]:self.offsets[i+1],:]
+
+    def fields(self,r,verts=None):
+        '''
+        field per ampere of each coil at the points r (npts,3).  verts
+        defaults to the nominal vertices, and may carry leading batch
+        dimensions.  Returns (...,ncoils,npts,3).  The segments are
+        summed in segment_blocks(), so only one block of per-segment
+        fields is held at a time.
+        '''
+        if verts is None:
+            verts=self.verts
+        r=np.reshape(r,(-1,3))
+        batch=np.shape(verts)[:-2]
+        fields=np.zeros(batch+(self.ncoils,len(r),3))
+        for block in segment_blocks(len(self.seg_start),int(np.prod(batch))*len(r)):
+            per_seg=segment_fields(verts[...,self.seg_start[block],:],verts[...,self.seg_end[block],:],r)
+            # segments are stored coil by coil, so each coil is a contiguous run
+            coil=self.coil_of_vert[self.seg_start[block]]
+            first=np.flatnonzero(np.diff(coil,prepend=-1))
+            fields[...,coil[first],:,:]+=np.add.reduceat(per_seg,first,axis=-3)
+        return fields
+
+    def sensitivity(self,r):
+        '''
+        first-order sensitivity of the field at the points r to the
+        vertices, per ampere of the coil owning each vertex.  Returns
+        (nverts,3,npts,3): [v,j,p,k] is dB_k at point p per metre of
+        coordinate j of vertex v.  Each vertex ends one segment and
+        starts the next.  The segments are done in segment_blocks(), so
+        only the result is held at full size.
+        '''
+        r=np.reshape(r,(-1,3))
+        sens=np.zeros((len(self.verts),3,len(r),3))
+        for block in segment_blocks(len(self.seg_start),3*len(r)):
+            dstart,dend=segment_sensitivities(self.verts[self.seg_start[block]],self.verts[self.seg_end[block]],r)
+            # each vertex starts one segment and ends one, so no index repeats in a block
+            sens[self.seg_start[block]]+=dstart
+            sens[self.seg_end[block]]+=dend
+        return sens
+
+    def linear_fields(self,fields0,sens,verts):
+        '''
+        first-order estimate of fields(r,verts), given fields0=fields(r)
+        and sens=sensitivity(r) of the nominal geometry.
+        '''
+        dv=verts-self.verts
+        per_vert=np.einsum('...vj,vjpk->...vpk',dv,sens)
+        return fields0+np.add.reduceat(per_vert,self.offsets[:-1],axis=-3)
+
+    def clearance(self,r):
+        '''
+        smallest distance from any segment to the points r
+        '''
+        r=np.reshape(r,(-1,3))
+        return np.amin(segment_distances(self.verts[self.seg_start],self.verts[self.seg_end],r))
+
+    def wiggle(self,sigma,rng,ntrials=None):
+        '''
+        perturbed copies of the vertices, each coordinate moved by a
+        gaussian of width sigma (m), like coilset.wiggle()
+        '''
+        shape=np.shape(self.verts) if ntrials is None else (ntrials,)+np.shape(self.verts)
+        return self.verts+rng.normal(0.,sigma,shape)
+
+class toleranceresult:
+    '''
+    per-trial results of a tolerancestudy.  fixed_std and refit_std are
+    (ntrials,3), the ROI residual std of (bx,by,bz) with the nominal
+    and the refit currents; currents is (ntrials,ncoils).
+    '''
+    def __init__(self,sigma,fixed_std,refit_std,currents):
+        self.sigma=sigma
+        self.fixed_std=fixed_std
+        self.refit_std=refit_std
+        self.currents=currents
+        self.ntrials=len(fixed_std)
+
+    def percentiles(self,q=(5,50,95)):
+        '''
+        dict of name -> array of the percentiles q of each quantity
+        '''
+        maxcurrent=np.amax(np.abs(self.currents),axis=1)
+        table={}
+        for k,comp in enumerate(('bx','by','bz')):
+            table['fixed %s std'%comp]=np.percentile(self.fixed_std[:,k],q)
+            table['refit %s std'%comp]=np.percentile(self.refit_std[:,k],q)
+        table['max |current|']=np.percentile(maxcurrent,q)
+        return table
+
+    def current_percentiles(self,q=(5,50,95)):
+        '''
+        (len(q),ncoils) percentiles of each coil's refit current
+        '''
+        return np.percentile(self.currents,q,axis=0)
+
+    def print_report(self,q=(5,50,95)):
+        print('Tolerance study: %d trials, sigma = %g mm'%(self.ntrials,self.sigma*1000))
+        print('%-16s'%'quantity'+''.join('%14s'%('p%g'%p) for p in q))
+        for name,values in self.percentiles(q).items():
+            print('%-16s'%name+''.join('%14.4e'%v for v in values))
+
+class tolerancestudy:
+    '''
+    Monte Carlo over perturbed coil geometries.  sensors is (ns,3) and
+    target the (3*ns,) vector of desired fields at them, in the order
+    of sensorarray.vec_b().  roi is (nr,3) and roi_target the (nr,3)
+    target field there.  currents are the nominal coil currents; if
+    None they are fit to the sensors for the nominal geometry.
+
+    The nominal responses at the sensors and on the ROI are cached
+    when the study is made.  With linear=True their first-order
+    sensitivities to the vertices are cached too, and trials whose
+    largest vertex move is below validity times the smallest
+    wire-to-point distance are estimated as a linear update; the rest
+    fall back to the exact Biot-Savart sum.
+    '''
+    def __init__(self,geometry,sensors,target,roi,roi_target,currents=None,
+                 linear=True,validity=0.05):
+        self.geometry=geometry
+        self.sensors=np.reshape(sensors,(-1,3))
+        self.target=np.ravel(target)
+        self.roi=np.reshape(roi,(-1,3))
+        self.roi_target=np.reshape(roi_target,(-1,3))
+        self.sensors0=geometry.fields(self.sensors)
+        self.m0=self.response(self.sensors0)
+        self.roi0=geometry.fields(self.roi)
+        if currents is None:
+            currents=np.linalg.pinv(self.m0).dot(self.target)
+        self.currents=np.asarray(currents,dtype=float)
+        self.linear=linear
+        if linear:
+            self.sensors_sens=geometry.sensitivity(self.sensors)
+            # flattened to (3*nverts,3*nr), so the ROI update is one matmul
+            self.roi_sens=geometry.sensitivity(self.roi).reshape(3*len(geometry.verts),-1)
+            self.max_linear_move=validity*geometry.clearance(np.concatenate((self.sensors,self.roi)))
+
+    def response(self,fields):
+        '''
+        (...,ncoils,ns,3) fields -> (...,3*ns,ncoils) matrix, the same
+        as the_matrix.capital_M
+        '''
+        shape=np.shape(fields)
+        return np.swapaxes(np.reshape(fields,shape[:-2]+(shape[-2]*3,)),-1,-2)
+
+    def evaluate(self,verts):
+        '''
+        evaluates a (ntrials,nverts,3) stack of perturbed vertices.
+        Returns (fixed_std,refit_std,currents).
+        '''
+        if not self.linear:
+            return self.evaluate_exact(verts)
+        dv=verts-self.geometry.verts
+        move=np.amax(np.sqrt(np.sum(dv*dv,axis=-1)),axis=-1)
+        lin=move<=self.max_linear_move
+        if np.all(lin):
+            return self.evaluate_linear(verts)
+        out=[np.empty((len(verts),3)),np.empty((len(verts),3)),
+             np.empty((len(verts),self.geometry.ncoils))]
+        for mask,method in ((lin,self.evaluate_linear),(~lin,self.evaluate_exact)):
+            if np.any(mask):
+                for o,r in zip(out,method(verts[mask])):
+                    o[mask]=r
+        return tuple(out)
+
+    def evaluate_exact(self,verts):
+        g=self.geometry
+        m=self.response(g.fields(self.sensors,verts))
+        roi=g.fields(self.roi,verts) # (ntrials,ncoils,nr,3)
+        refit=np.einsum('tcs,s->tc',np.linalg.pinv(m),self.target)
+        fixed_res=np.einsum('tcrk,c->trk',roi,self.currents)-self.roi_target
+        refit_res=np.einsum('tcrk,tc->trk',roi,refit)-self.roi_target
+        return np.std(fixed_res,axis=1),np.std(refit_res,axis=1),refit
+
+    def evaluate_linear(self,verts):
+        g=self.geometry
+        ntrials=len(verts)
+        dv=verts-g.verts
+        m=self.response(g.linear_fields(self.sensors0,self.sensors_sens,verts))
+        refit=np.einsum('tcs,s->tc',np.linalg.pinv(m),self.target)
+        # sum over coils of current*(nominal field + sensitivity.dv),
+        # with each vertex weighted by the current of its coil
+        fixed_dv=(dv*self.currents[g.coil_of_vert][:,np.newaxis]).reshape(ntrials,-1)
+        refit_dv=(dv*refit[:,g.coil_of_vert,np.newaxis]).reshape(ntrials,-1)
+        fixed_b=np.einsum('crk,c->rk',self.roi0,self.currents)+fixed_dv.dot(self.roi_sens).reshape(ntrials,-1,3)
+        refit_b=np.einsum('crk,tc->trk',self.roi0,refit)+refit_dv.dot(self.roi_sens).reshape(ntrials,-1,3)
+        fixed_res=fixed_b-self.roi_target
+        refit_res=refit_b-self.roi_target
+        return np.std(fixed_res,axis=1),np.std(refit_res,axis=1),refit
+
+    def run_batch(self,seedseq,ntrials,sigma):
+        rng=np.random.default_rng(seedseq)
+        return self.evaluate(self.geometry.wiggle(sigma,rng,ntrials))
+
+    def run(self,ntrials,sigma,seed=0,batch=64,workers=1):
+        '''
+        runs ntrials trials with gaussian vertex errors of width sigma
+        (m).  Each batch of trials has its own child of the seed, so the
+        result does not depend on the number of workers.  The study
+        with its cached sensitivities goes to each worker process once,
+        and only (seed,ntrials,sigma) goes with each batch.
+        '''
+        sizes=[min(batch,ntrials-i) for i in range(0,ntrials,batch)]
+        seeds=np.random.SeedSequence(seed).spawn(len(sizes))
+        args=(seeds,sizes,[sigma]*len(sizes))
+        if workers>1:
+            with ProcessPoolExecutor(max_workers=workers,initializer=set_worker_study,initargs=(self,)) as pool:
+                out=list(pool.map(run_worker_batch,*args))
+        else:
+            out=list(map(self.run_batch,*args))
+        fixed_std,refit_std,currents=(np.concatenate(x) for x in zip(*out))
+        return toleranceresult(sigma,fixed_std,refit_std,currents)
+
+# the study of a worker process of tolerancestudy.run(), set once when
+# the process starts
+worker_study=None
+
+def set_worker_study(study):
+    global worker_study
+    worker_study=study
+
+def run_worker_batch(seedseq,ntrials,sigma):
+    return worker_study.run_batch(seedseq,ntrials,sigma)
+
+# one row per coil.  d? are per mm of translation along ?, r? per
+# degree of rotation about the ? axis through the coil's centroid,
+# each the RMS over the ROI of the induced |B| in nT.  mm and deg are
+# the worst axis of each, and the coils are ranked on them separately.
+ranking_dtype=np.dtype([('coil','i8'),
+                        ('rank_mm','i8'),
+                        ('rank_deg','i8'),
+                        ('current','f8'),
+                        ('dx','f8'),('dy','f8'),('dz','f8'),
+                        ('rx','f8'),('ry','f8'),('rz','f8'),
+                        ('mm','f8'),
+                        ('deg','f8')])
+
+def coil_placement_sensitivity(geometry,roi,currents,sens=None):
+    '''
+    ROI field error induced by a rigid 1 mm translation or 1 degree
+    rotation of each coil at its current, for all coils at once from
+    the vertex sensitivities (sens=geometry.sensitivity(roi) may be
+    passed in if it is already known).  Returns a ranking_dtype array
+    in coil order; rank 0 is the most sensitive coil.
+    '''
+    roi=np.reshape(roi,(-1,3))
+    if sens is None:
+        sens=geometry.sensitivity(roi)
+    sens=np.reshape(sens,(len(geometry.verts),3,len(roi),3))
+    currents=np.asarray(currents,dtype=float)
+    # translations: every vertex of the coil moves by the same unit vector
+    trans=np.add.reduceat(sens,geometry.offsets[:-1],axis=0) # (ncoils,3,nr,3)
+    # rotations about axis a: vertex v moves by a x (v-centroid) per radian
+    arm=geometry.verts-geometry.centroids()[geometry.coil_of_vert]
+    moves=np.cross(np.eye(3)[np.newaxis,:,:],arm[:,np.newaxis,:]) # (nverts,3 axes,3)
+    rot=np.add.reduceat(np.einsum('vaj,vjpk->vapk',moves,sens),geometry.offsets[:-1],axis=0)
+    scale=currents[:,np.newaxis]*1e9 # T/A -> nT at the coil current
+    per_mm=np.sqrt(np.mean(np.sum(trans**2,axis=-1),axis=-1))*np.abs(scale)*1e-3
+    per_deg=np.sqrt(np.mean(np.sum(rot**2,axis=-1),axis=-1))*np.abs(scale)*np.pi/180
+    table=np.zeros(geometry.ncoils,dtype=ranking_dtype)
+    table['coil']=np.arange(geometry.ncoils)
+    table['current']=currents
+    for k,axis in enumerate('xyz'):
+        table['d'+axis]=per_mm[:,k]
+        table['r'+axis]=per_deg[:,k]
+    table['mm']=np.amax(per_mm,axis=1)
+    table['deg']=np.amax(per_deg,axis=1)
+    table['rank_mm'][np.argsort(-table['mm'],kind='stable')]=np.arange(geometry.ncoils)
+    table['rank_deg'][np.argsort(-table['deg'],kind='stable')]=np.arange(geometry.ncoils)
+    return table
+
+def format_ranking(table):
+    lines=['# ROI RMS |B| error (nT) per mm translation (d) and per degree rotation (r)',
+           '%5s %8s %8s %12s'%('#coil','rank_mm','rank_deg','current(A)')
+           +''.join('%12s'%name for name in ranking_dtype.names[4:])]
+    for row in table:
+        lines.append('%5d %8d %8d %12.5e'%(row['coil'],row['rank_mm'],row['rank_deg'],row['current'])
+                     +''.join('%12.5e'%row[name] for name in ranking_dtype.names[4:]))
+    return lines
+
+def write_ranking(table,filename):
+    '''
+    writes the table in coil order, one fixed-width row per coil, so
+    that two geometry revisions can be compared with diff
+    '''
+    with open(filename,'w') as f:
+        f.write('\n'.join(format_ranking(table))+'\n')
+
+def print_ranking(table,n=10,order='rank_mm'):
+    lines=format_ranking(np.sort(table,order=order)[:n])
+    print('The %d coils most sensitive to placement (by %s):'%(min(n,len(table)),order))
+    print('\n'.join(lines[1:]))